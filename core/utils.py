@@ -1,3 +1,9 @@
+from datetime import datetime
+import hashlib
+from typing import Callable, Optional
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from crispy_forms.layout import Div, HTML, Submit
 
 
@@ -7,3 +13,24 @@ def crispy_save_or_go_back(save_text='Save!'):
         Submit(save_text, save_text),
         css_class="btn-group"
     )
+
+
+def make_etag(*parts: object) -> str:
+    digest = hashlib.sha1('\0'.join(str(x) for x in parts).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def conditional_response(request: HttpRequest, etag: str, last_modified: Optional[datetime],
+                         compute: Callable[[], HttpResponse], private: bool = False) -> HttpResponse:
+    # Answers If-None-Match/If-Modified-Since with a 304 without calling compute. Responses that also
+    # depend on the clock have no last_modified: it would say nothing about the time they were computed at
+    last_modified = last_modified and int(last_modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = compute()
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Clients (and proxies, unless private) can keep the response, but need to revalidate it every time
+    response['Cache-Control'] = 'private, no-cache' if private else 'no-cache'
+    return response
@@ -8,6 +8,11 @@ echo "----Creating fake db"
 rm media/*
 python3 manage.py resetdb
 
+# Start the notification workers
+echo "----Starting notification workers"
+python3 manage.py sendnotifications &
+python3 manage.py sendreminders &
+
 # Start server
 echo "----Starting server"
 python3 manage.py runserver 0.0.0.0:8000
@@ -0,0 +1,157 @@
+import asyncio
+from datetime import datetime
+import json
+from typing import Optional
+from asgiref.sync import sync_to_async
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from core.utils import make_etag
+
+from . import events
+from .positions import get_line
+
+# Tickets listed after the one being served
+BOARD_NEXT_COUNT = 5
+# Boards are recomputed at least this often, the opening state moves with the clock
+BOARD_CACHE_SECS = 60
+# Longest wait of a long-polling display
+BOARD_LONG_POLL_SECS = 25
+BOARD_TOKEN_SALT = 'queues.board'
+
+
+def board_cache_key(queue_id) -> str:
+    return f'queue-board-{queue_id}'
+
+
+def make_board_token(queue) -> str:
+    # Displays are not logged in, the board URL carries a signed token instead. Kiosks stay on for days,
+    # so it does not expire: links are revoked by QQueue.rotate_board_token
+    return signing.dumps([str(queue.id), queue.board_token_version], salt=BOARD_TOKEN_SALT)
+
+
+def check_board_token(token: Optional[str], queue_id, entry: Optional[dict]) -> bool:
+    # entry: cache entry of the board (see get_board), None if the queue does not exist
+    if not token or entry is None:
+        return False
+    try:
+        data = signing.loads(token, salt=BOARD_TOKEN_SALT)
+    except signing.BadSignature:
+        return False
+    if not isinstance(data, list) or len(data) != 2:
+        return False
+    return data[0].replace('-', '') == str(queue_id).replace('-', '') and data[1] == entry['tokenVersion']
+
+
+def format_ticket(ticket_id: int, requested_time: datetime, tz) -> dict:
+    # Public: no names, only the ticket number and time
+    return {'number': ticket_id, 'time': requested_time.astimezone(tz).strftime('%H:%M')}
+
+
+def compute_board(queue, now: Optional[datetime]=None) -> dict:
+    """
+    Cache entry of the display board of a queue: { version, tokenVersion, etag, time, board }.
+
+    Built from what the manage page shows: the state of the day, and today's open tickets
+    (read from the queue's line, see queues.positions), plus the last served ticket.
+    """
+    from .models import TicketState
+
+    if now is None:
+        now = timezone.now()
+    now = now.astimezone(queue.tz)
+    state, open_range = queue.get_service_state(now)
+    line = get_line(queue.id, now.date())
+    waiting = line.count()
+    start, end = queue.get_day_bounds(now.date())
+    serving = queue.tickets_set\
+        .filter(state=TicketState.SERVED, requested_time__gte=start, requested_time__lt=end)\
+        .order_by('-closure_time')\
+        .values_list('id', 'requested_time')\
+        .first()
+    board = {
+        'queue': queue.name,
+        'state': state,
+        'openRange': [x.strftime('%H:%M') for x in open_range] if open_range is not None else None,
+        'nowServing': format_ticket(*serving, queue.tz) if serving is not None else None,
+        'next': [
+            format_ticket(ticket_id, start, queue.tz)
+            for ticket_id, start in line.values_list('ticket_id', 'start')[:BOARD_NEXT_COUNT]
+        ],
+        'waiting': waiting,
+        'waitSecs': int(waiting * queue.expected_time_per_ticket),
+    }
+    return {
+        'version': queue.version,
+        'tokenVersion': queue.board_token_version,
+        'etag': make_etag(queue.id, json.dumps(board, sort_keys=True)),
+        'time': now,
+        'board': board,
+    }
+
+
+def store_board(queue_id, entry: dict):
+    # A slower refresh of an older version must not overwrite a newer board
+    cached = cache.get(board_cache_key(queue_id))
+    if cached is None or cached['version'] <= entry['version']:
+        cache.set(board_cache_key(queue_id), entry, BOARD_CACHE_SECS)
+
+
+def get_board(queue_id) -> Optional[dict]:
+    # Cache entry of the board, None if the queue does not exist
+    from .models import QQueue
+
+    entry = cache.get(board_cache_key(queue_id))
+    if entry is None:
+        queue = QQueue.objects.filter(id=queue_id).first()
+        if queue is None:
+            return None
+        entry = compute_board(queue)
+        store_board(queue_id, entry)
+    return entry
+
+
+def on_queue_changed(queue_id):
+    # Precomputes the board after a ticket transition commits, only for queues whose board is
+    # being displayed (the others are computed on the first request)
+    def refresh():
+        from .models import QQueue
+
+        if cache.get(board_cache_key(queue_id)) is None:
+            return
+        queue = QQueue.objects.filter(id=queue_id).first()
+        if queue is not None:
+            store_board(queue_id, compute_board(queue))
+    transaction.on_commit(refresh)
+
+
+async def wait_board(queue_id, etag: str, timeout: float) -> Optional[dict]:
+    """
+    Long poll: waits until the board changes from etag, for up to timeout seconds.
+
+    Woken by the queue's events (published after the board is refreshed), so a waiting display
+    only reads the cache once per change. Under ASGI it only costs a coroutine, not a thread.
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    unsubscribe = events.get_broker().subscribe(
+        events.queue_channel(queue_id),
+        lambda message: loop.call_soon_threadsafe(changed.set),
+    )
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            entry = await sync_to_async(get_board)(queue_id)
+            remaining = deadline - loop.time()
+            if entry is None or entry['etag'] != etag or remaining <= 0:
+                return entry
+            # Not every event changes the board (e.g. tickets of other days)
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+    finally:
+        unsubscribe()
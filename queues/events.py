@@ -0,0 +1,214 @@
+import asyncio
+import json
+import queue as sync_queue
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# Clients get a comment line this often, so that proxies don't drop idle streams
+HEARTBEAT_SECS = 15
+# Streams served by a (sync) Django view are closed after a while, the browser reconnects by itself
+SYNC_STREAM_MAX_SECS = 5 * 60
+# Async streams are cheaper but also reconnected once in a while, so that their token is checked again
+STREAM_MAX_SECS = 60 * 60
+TOKEN_SALT = 'queues.events'
+TOKEN_MAX_AGE_SECS = 12 * 60 * 60
+# Handled by EventStreamApp under ASGI, by views.queue_events otherwise
+EVENTS_PATH = re.compile(r'^/queue/(?P<pk>[0-9a-fA-F-]{32,36})/events$')
+
+
+class LocalBroker:
+    """
+    In-process publish/subscribe of the queue events.
+
+    Only reaches the subscribers of the same process, deployments with several processes should
+    point QUEUES_EVENT_BROKER to a broker with the same interface backed by a shared service.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[Callable[[dict], None]]] = {}
+
+    def publish(self, channel: str, message: dict):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel: str, callback: Callable[[dict], None]) -> Callable[[], None]:
+        # Returns the function that cancels the subscription. Callbacks are called from the
+        # publishing thread, they must not block
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(callback)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._subscribers.get(channel)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._subscribers[channel]
+        return unsubscribe
+
+    def subscriber_count(self, channel: str) -> int:
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(getattr(settings, 'QUEUES_EVENT_BROKER', 'queues.events.LocalBroker'))()
+        return _broker
+
+
+def queue_channel(queue_id) -> str:
+    return f'queue:{queue_id}'
+
+
+def publish(queue_id, event_type: str, tickets: List[dict]):
+    # Sent once the current transaction commits, rolled back changes are never announced
+    message = {'type': event_type, 'tickets': tickets}
+    transaction.on_commit(lambda: get_broker().publish(queue_channel(queue_id), message))
+
+
+def make_token(queue_id, ticket_id: Optional[int]=None, user_id: Optional[int]=None) -> str:
+    # Staff tokens (no ticket, given to user_id) see every event of the queue, ticket tokens only the ones of their ticket
+    return signing.dumps({'q': str(queue_id), 't': ticket_id, 'u': user_id}, salt=TOKEN_SALT)
+
+
+def read_token(token: Optional[str], queue_id) -> Optional[dict]:
+    """
+    Scope of a stream token, None if it is not valid (anymore).
+
+    Checked every time a stream connects (browsers reconnect by themselves): the role of the user
+    of a staff token is read again, so that removed admins stop getting the events.
+    """
+    from .models import QueueUser, QueueUserRole
+
+    if not token:
+        return None
+    try:
+        data = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE_SECS)
+    except signing.BadSignature:
+        return None
+    if data.get('q').replace('-', '') != str(queue_id).replace('-', ''):
+        return None
+    if data.get('t') is None and not QueueUser.objects.filter(
+        queue=data['q'], user=data.get('u'), role__in=[QueueUserRole.OWNER, QueueUserRole.EMPLOYEE],
+    ).exists():
+        return None
+    return data
+
+
+def filter_message(message: dict, scope: dict) -> dict:
+    # Ticket pages only learn about their own ticket, and that something else changed in the queue
+    ticket_id = scope.get('t')
+    if ticket_id is None:
+        return message
+    tickets = [t for t in message['tickets'] if t['id'] == ticket_id]
+    if not tickets:
+        return {'type': 'queue', 'tickets': []}
+    return {'type': message['type'], 'tickets': tickets}
+
+
+def format_message(message: dict) -> bytes:
+    return f"event: {message['type']}\ndata: {json.dumps(message)}\n\n".encode()
+
+
+HEARTBEAT = b': ping\n\n'
+
+
+def stream_sync(queue_id, scope: dict, max_secs: float=SYNC_STREAM_MAX_SECS) -> Iterator[bytes]:
+    # Blocking stream, one thread per client: only meant for WSGI servers (and development)
+    messages = sync_queue.SimpleQueue()
+    unsubscribe = get_broker().subscribe(queue_channel(queue_id), messages.put)
+    try:
+        yield HEARTBEAT
+        deadline = time.monotonic() + max_secs
+        while time.monotonic() < deadline:
+            try:
+                message = messages.get(timeout=min(HEARTBEAT_SECS, max(deadline - time.monotonic(), 0)))
+            except sync_queue.Empty:
+                yield HEARTBEAT
+                continue
+            yield format_message(filter_message(message, scope))
+    finally:
+        unsubscribe()
+
+
+class EventStreamApp:
+    """
+    ASGI app serving the event streams, every other request goes to the Django app.
+
+    Django 4.0 cannot stream from async code, so the streams are served here: a waiting client
+    only costs a coroutine instead of a thread.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        match = EVENTS_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.app(scope, receive, send)
+
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token_scope = await sync_to_async(read_token)(query.get('token', [None])[0], match['pk'])
+        if token_scope is None:
+            await send({'type': 'http.response.start', 'status': 403, 'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Forbidden'})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue()
+        unsubscribe = get_broker().subscribe(
+            queue_channel(token_scope['q']),
+            lambda message: loop.call_soon_threadsafe(messages.put_nowait, message),
+        )
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({'type': 'http.response.body', 'body': HEARTBEAT, 'more_body': True})
+            deadline = loop.time() + STREAM_MAX_SECS
+            while loop.time() < deadline:
+                message = asyncio.ensure_future(messages.get())
+                timeout = min(HEARTBEAT_SECS, max(deadline - loop.time(), 0))
+                done, _ = await asyncio.wait({message, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    message.cancel()
+                    break
+                if message in done:
+                    body = format_message(filter_message(message.result(), token_scope))
+                else:
+                    message.cancel()
+                    body = HEARTBEAT
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+            else:
+                # Ends the response, the browser reconnects
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            unsubscribe()
+            disconnected.cancel()
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
@@ -1,6 +1,7 @@
 from datetime import datetime, time
 from django import forms
 from django.core.exceptions import ValidationError
+from django.urls import reverse_lazy
 from django.utils.translation import gettext_lazy as _
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Div, HTML
@@ -83,7 +84,12 @@ class ScheduleForm(forms.Form):
         return self.instance
 
 class ExistingUserForm(forms.Form):
-    username = forms.CharField(label='Username')
+    # Suggested while typing by user/username_autocomplete.html
+    username = forms.CharField(label='Username', widget=forms.TextInput(attrs={
+        'autocomplete': 'off',
+        'list': 'username-suggestions',
+        'data-autocomplete-url': reverse_lazy('users:autocomplete'),
+    }))
 
     def clean(self):
         cleaned_data = super().clean()
@@ -150,6 +156,8 @@ class QueueRangeExceptionForm(forms.Form):
     from_time = forms.TimeField(widget=forms.TimeInput(format="%H:%M"))
     to_time = forms.TimeField(widget=forms.TimeInput(format="%H:%M"))
     keep_closed = forms.BooleanField(initial=False, required=False)
+    cancel_tickets = forms.BooleanField(label='Cancel the tickets left out', initial=False, required=False)
+    message = forms.CharField(max_length=128, required=False, initial="Sorry, the queue closed early")
 
     def __init__(self, *args, queue: QQueue, **kwargs) -> None:
         super().__init__(*args, **kwargs)
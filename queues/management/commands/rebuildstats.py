@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from queues.models import QQueue, QueueDailyStats
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily statistics of the queues from their tickets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queues', nargs='*', help='Ids of the queues to rebuild (default: all)')
+
+    def handle(self, *args, **options):
+        queues = QQueue.objects.all()
+        if options['queues']:
+            queues = queues.filter(id__in=options['queues'])
+
+        for queue in queues:
+            QueueDailyStats.rebuild(queue)
+            self.stdout.write(f"Rebuilt {queue.name}")
@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+
+from queues.notifications import deliver_due
+
+class Command(BaseCommand):
+    help = 'Delivers the pending web push notifications, retrying the failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Deliver the due notifications and exit')
+        parser.add_argument('--interval', type=float, default=2, help='Seconds between two polls when idle')
+        parser.add_argument('--batch', type=int, default=100, help='Notifications picked up at once')
+
+    def handle(self, *args, **options):
+        while True:
+            n = deliver_due(options['batch'])
+            if n > 0:
+                self.stdout.write(f"Delivered {n} notifications")
+            if options['once']:
+                break
+            if n < options['batch']:
+                time.sleep(options['interval'])
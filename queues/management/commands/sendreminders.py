@@ -0,0 +1,36 @@
+from datetime import timedelta
+import os
+import socket
+import time
+from django.core.management.base import BaseCommand
+
+from queues.models import WorkerLease
+from queues.notifications import remind_due
+
+LEASE_NAME = 'sendreminders'
+
+class Command(BaseCommand):
+    help = 'Queues the ticket reminders when they are due, can run on several nodes (only one is active at a time)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Queue the due reminders and exit')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between two polls when idle')
+        parser.add_argument('--batch', type=int, default=100, help='Tickets picked up at once')
+        parser.add_argument('--lease', type=float, default=60, help='Seconds the lease is held without being renewed')
+
+    def handle(self, *args, **options):
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        lease = timedelta(seconds=max(options['lease'], 2 * options['interval']))
+        try:
+            while True:
+                n = 0
+                if WorkerLease.acquire(LEASE_NAME, owner, lease):
+                    n = remind_due(options['batch'])
+                    if n > 0:
+                        self.stdout.write(f"Queued {n} reminders")
+                if options['once']:
+                    break
+                if n < options['batch']:
+                    time.sleep(options['interval'])
+        finally:
+            WorkerLease.release(LEASE_NAME, owner)
@@ -0,0 +1,30 @@
+from django.db.models import Exists, OuterRef
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from queues.models import QQueue, Ticket, TicketState
+
+POLICIES = {
+    'expire': (TicketState.EXPIRED, None),
+    'cancel': (TicketState.QUEUE_CANCELLED, "Expired"),
+}
+
+class Command(BaseCommand):
+    help = 'Closes the tickets that were left open on past days (run it daily)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--policy', choices=POLICIES.keys(), default='expire', help='State given to the stale tickets')
+        parser.add_argument('--chunk', type=int, default=500, help='Tickets closed per transaction')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        state, message = POLICIES[options['policy']]
+        # Every queue decides what "past" means in its own timezone, this only skips the queues with nothing to do
+        stale = Ticket.objects.filter(queue=OuterRef('pk'), state=TicketState.OPEN, requested_time__lt=now)
+        total = 0
+        for queue in QQueue.objects.filter(Exists(stale)):
+            n = queue.expire_stale_tickets(now, state=state, message=message, chunk_size=options['chunk'])
+            if n > 0:
+                self.stdout.write(f"{queue.name}: {n} tickets closed")
+            total += n
+        self.stdout.write(f"Closed {total} stale tickets")
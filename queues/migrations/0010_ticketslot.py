@@ -0,0 +1,44 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_slots(apps, schema_editor):
+    Ticket = apps.get_model('queues', 'Ticket')
+    TicketSlot = apps.get_model('queues', 'TicketSlot')
+
+    TicketSlot.objects.bulk_create(
+        TicketSlot(
+            ticket=t,
+            queue_id=t.queue_id,
+            day=t.requested_time.astimezone(t.queue.tz).date(),
+            start=t.requested_time,
+        )
+        for t in Ticket.objects.filter(state='OPE').select_related('queue')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0009_alter_userqueuereport_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketSlot',
+            fields=[
+                ('ticket', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='slot', serialize=False, to='queues.ticket', verbose_name='ticket')),
+                ('day', models.DateField(verbose_name='day')),
+                ('start', models.DateTimeField(verbose_name='start')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slots_set', to='queues.qqueue', verbose_name='queue')),
+            ],
+            options={
+                'verbose_name': 'Ticket slot',
+                'verbose_name_plural': 'Ticket slots',
+                'indexes': [models.Index(fields=['queue', 'day', 'start'], name='ticketslot_queue_day_idx')],
+            },
+        ),
+        migrations.RunPython(fill_slots, migrations.RunPython.noop),
+    ]
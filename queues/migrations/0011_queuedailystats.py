@@ -0,0 +1,36 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0010_ticketslot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='day')),
+                ('served', models.IntegerField(default=0, verbose_name='Served')),
+                ('canceled_queue', models.IntegerField(default=0, verbose_name='Cancelled by the queue')),
+                ('canceled_user', models.IntegerField(default=0, verbose_name='Cancelled by the user')),
+                ('open', models.IntegerField(default=0, verbose_name='Open')),
+                ('wait_sum', models.BigIntegerField(default=0, verbose_name='Wait time sum')),
+                ('wait_count', models.IntegerField(default=0, verbose_name='Wait time count')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='queues.qqueue', verbose_name='queue')),
+            ],
+            options={
+                'verbose_name': 'Daily statistics',
+                'verbose_name_plural': 'Daily statistics',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='queuedailystats',
+            constraint=models.UniqueConstraint(fields=('queue', 'day'), name='queuedailystats_queue_day_unique'),
+        ),
+    ]
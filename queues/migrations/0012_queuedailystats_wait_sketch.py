@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0011_queuedailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedailystats',
+            name='wait_sketch',
+            field=models.JSONField(default=dict, verbose_name='Wait time sketch'),
+        ),
+    ]
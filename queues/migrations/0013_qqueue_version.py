@@ -0,0 +1,24 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:56
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0012_queuedailystats_wait_sketch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qqueue',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, editable=False, verbose_name='Version'),
+        ),
+        migrations.AddField(
+            model_name='qqueue',
+            name='version_time',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Version time'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:57
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicates(apps, schema_editor):
+    # Only the most recent row of each (queue, user) and (queue, day) pair is kept
+    for model, fields in [('QueueUser', ('queue', 'user')), ('QueueOpenException', ('queue', 'day'))]:
+        Model = apps.get_model('queues', model)
+        keep = Model.objects.values(*fields).annotate(last=Max('id')).values_list('last', flat=True)
+        Model.objects.exclude(id__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0013_qqueue_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['queue', 'state', 'requested_time'], name='ticket_queue_state_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['queue', 'requested_time'], name='ticket_queue_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['user', 'requested_time'], name='ticket_user_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='queueopenexception',
+            constraint=models.UniqueConstraint(fields=('queue', 'day'), name='queueopenexception_queue_day_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='queueuser',
+            constraint=models.UniqueConstraint(fields=('queue', 'user'), name='queueuser_queue_user_unique'),
+        ),
+    ]
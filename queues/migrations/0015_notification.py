@@ -0,0 +1,37 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('queues', '0014_ticket_indexes_and_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField(verbose_name='Payload')),
+                ('ttl', models.IntegerField(default=0, verbose_name='Time to live')),
+                ('creation_time', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('state', models.CharField(choices=[('PEN', 'Pending'), ('SEN', 'Sent'), ('FAI', 'Failed')], default='PEN', max_length=3)),
+                ('next_attempt_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('sent_time', models.DateTimeField(default=None, null=True, verbose_name='Sent time')),
+                ('last_error', models.CharField(default=None, max_length=256, null=True, verbose_name='Last error')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications_set', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'Notification',
+                'verbose_name_plural': 'Notifications',
+                'indexes': [models.Index(fields=['state', 'next_attempt_time'], name='notification_due_idx')],
+            },
+        ),
+    ]
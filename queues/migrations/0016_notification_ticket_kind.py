@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-18 05:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0015_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('NXT', 'Next in line')], default=None, max_length=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='ticket',
+            field=models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='notifications_set', to='queues.ticket', verbose_name='ticket'),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('ticket', 'kind'), name='notification_ticket_kind_unique'),
+        ),
+    ]
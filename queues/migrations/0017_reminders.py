@@ -0,0 +1,40 @@
+# Generated by Django 4.0.5 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0016_notification_ticket_kind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerLease',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Name')),
+                ('owner', models.CharField(max_length=128, verbose_name='Owner')),
+                ('expire_time', models.DateTimeField(verbose_name='Expiration time')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='qqueue',
+            name='reminder_minutes',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='Reminder (minutes before)'),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='remind_time',
+            field=models.DateTimeField(default=None, editable=False, null=True, verbose_name='Reminder time'),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('NXT', 'Next in line'), ('REM', 'Reminder')], default=None, max_length=3, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(('remind_time__isnull', False)), fields=['remind_time'], name='ticket_remind_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 05:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0017_reminders'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('NXT', 'Next in line'), ('REM', 'Reminder'), ('CAN', 'Cancelled')], default=None, max_length=3, null=True),
+        ),
+    ]
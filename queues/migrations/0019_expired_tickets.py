@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0018_notification_kind_cancelled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queuedailystats',
+            name='expired',
+            field=models.IntegerField(default=0, verbose_name='Expired'),
+        ),
+        migrations.AlterField(
+            model_name='ticket',
+            name='state',
+            field=models.CharField(choices=[('OPE', 'Open'), ('UCA', 'Cancelled by the user'), ('QCA', 'Cancelled by a queue operator'), ('SER', 'Served'), ('EXP', 'Expired')], default='OPE', max_length=3),
+        ),
+    ]
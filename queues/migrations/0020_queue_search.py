@@ -0,0 +1,98 @@
+# Generated by Django 4.0.5 on 2026-10-18 05:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# External content FTS5 table, kept in sync with the documents by triggers. Searches match word
+# prefixes, short ones (the most expensive to expand) have their own index
+SQLITE_CREATE = [
+    """CREATE VIRTUAL TABLE queues_queuesearchindex USING fts5(
+        name, description,
+        content='queues_queuesearchdocument', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    # Names weigh more than descriptions
+    "INSERT INTO queues_queuesearchindex(queues_queuesearchindex, rank) VALUES('rank', 'bm25(10.0, 1.0)')",
+    """CREATE TRIGGER queues_queuesearchdocument_ai AFTER INSERT ON queues_queuesearchdocument BEGIN
+        INSERT INTO queues_queuesearchindex(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER queues_queuesearchdocument_ad AFTER DELETE ON queues_queuesearchdocument BEGIN
+        INSERT INTO queues_queuesearchindex(queues_queuesearchindex, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER queues_queuesearchdocument_au AFTER UPDATE ON queues_queuesearchdocument BEGIN
+        INSERT INTO queues_queuesearchindex(queues_queuesearchindex, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO queues_queuesearchindex(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+SQLITE_DROP = [
+    "DROP TRIGGER queues_queuesearchdocument_ai",
+    "DROP TRIGGER queues_queuesearchdocument_ad",
+    "DROP TRIGGER queues_queuesearchdocument_au",
+    "DROP TABLE queues_queuesearchindex",
+]
+
+POSTGRESQL_CREATE = [
+    """ALTER TABLE queues_queuesearchdocument ADD COLUMN document tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'B')
+    ) STORED""",
+    "CREATE INDEX queuesearchdocument_document_idx ON queues_queuesearchdocument USING GIN (document)",
+]
+POSTGRESQL_DROP = [
+    "DROP INDEX queuesearchdocument_document_idx",
+    "ALTER TABLE queues_queuesearchdocument DROP COLUMN document",
+]
+
+
+def run_vendor_sql(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+def fill_documents(apps, schema_editor):
+    QQueue = apps.get_model('queues', 'QQueue')
+    QueueSearchDocument = apps.get_model('queues', 'QueueSearchDocument')
+
+    QueueSearchDocument.objects.bulk_create(
+        QueueSearchDocument(queue=q, name=q.name, description=q.description)
+        for q in QQueue.objects.all()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0019_expired_tickets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, verbose_name='Name')),
+                ('description', models.CharField(default='', max_length=1024, verbose_name='Description')),
+                ('queue', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='queues.qqueue', verbose_name='queue')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QueueSearchIndex',
+            fields=[
+                ('document', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='index', serialize=False, to='queues.queuesearchdocument')),
+                ('match', models.TextField(db_column='queues_queuesearchindex')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'queues_queuesearchindex',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(
+            run_vendor_sql({'sqlite': SQLITE_CREATE, 'postgresql': POSTGRESQL_CREATE}),
+            run_vendor_sql({'sqlite': SQLITE_DROP, 'postgresql': POSTGRESQL_DROP}),
+        ),
+        migrations.RunPython(fill_documents, migrations.RunPython.noop),
+    ]
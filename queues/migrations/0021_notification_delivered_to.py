@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 06:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0020_queue_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='delivered_to',
+            field=models.JSONField(default=list, verbose_name='Delivered to'),
+        ),
+    ]
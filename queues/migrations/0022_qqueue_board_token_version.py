@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 06:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0021_notification_delivered_to'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qqueue',
+            name='board_token_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Board link version'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.0.5 on 2026-10-18 06:58
+
+from django.db import migrations
+
+
+# SQLite's index already folds diacritics (remove_diacritics), PostgreSQL needs unaccent for the same
+# matches. unaccent() is only STABLE, generated columns need an IMMUTABLE wrapper with a fixed dictionary
+POSTGRESQL_CREATE = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """CREATE OR REPLACE FUNCTION queues_unaccent(text) RETURNS text AS $$
+        SELECT public.unaccent('public.unaccent', $1)
+    $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT""",
+    "DROP INDEX queuesearchdocument_document_idx",
+    "ALTER TABLE queues_queuesearchdocument DROP COLUMN document",
+    """ALTER TABLE queues_queuesearchdocument ADD COLUMN document tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', queues_unaccent(name)), 'A') || setweight(to_tsvector('simple', queues_unaccent(description)), 'B')
+    ) STORED""",
+    "CREATE INDEX queuesearchdocument_document_idx ON queues_queuesearchdocument USING GIN (document)",
+]
+POSTGRESQL_DROP = [
+    "DROP INDEX queuesearchdocument_document_idx",
+    "ALTER TABLE queues_queuesearchdocument DROP COLUMN document",
+    """ALTER TABLE queues_queuesearchdocument ADD COLUMN document tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'B')
+    ) STORED""",
+    "CREATE INDEX queuesearchdocument_document_idx ON queues_queuesearchdocument USING GIN (document)",
+    "DROP FUNCTION queues_unaccent(text)",
+]
+
+
+def run_vendor_sql(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0022_qqueue_board_token_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_vendor_sql({'postgresql': POSTGRESQL_CREATE}),
+            run_vendor_sql({'postgresql': POSTGRESQL_DROP}),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.5 on 2026-10-18 07:40
+
+from collections import defaultdict
+from django.db import migrations
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+
+from queues.sketch import WaitSketch
+
+
+def fill_daily_stats(apps, schema_editor):
+    # The rollups only followed the tickets changed since 0011: recomputes them for the tickets
+    # that existed before, same as QueueDailyStats.rebuild (the rebuildstats command)
+    QQueue = apps.get_model('queues', 'QQueue')
+    QueueDailyStats = apps.get_model('queues', 'QueueDailyStats')
+
+    served = Q(state='SER')
+    for queue in QQueue.objects.all():
+        rows = queue.tickets_set\
+            .annotate(day=TruncDate('requested_time', tzinfo=queue.tz))\
+            .values('day')\
+            .annotate(
+                served=Count('id', filter=served),
+                canceled_queue=Count('id', filter=Q(state='QCA')),
+                canceled_user=Count('id', filter=Q(state='UCA')),
+                open=Count('id', filter=Q(state='OPE')),
+                expired=Count('id', filter=Q(state='EXP')),
+                wait_sum=Coalesce(Sum('wait_time_secs', filter=served), 0),
+                wait_count=Count('wait_time_secs', filter=served),
+            )\
+            .order_by('day')
+
+        sketches = defaultdict(WaitSketch)
+        waits = queue.tickets_set\
+            .filter(served, wait_time_secs__isnull=False)\
+            .values_list('requested_time', 'wait_time_secs')
+        for requested_time, wait_time_secs in waits.iterator():
+            sketches[requested_time.astimezone(queue.tz).date()].add(wait_time_secs)
+
+        QueueDailyStats.objects.filter(queue=queue).delete()
+        QueueDailyStats.objects.bulk_create(
+            QueueDailyStats(queue=queue, wait_sketch=sketches[row['day']].to_json(), **row)
+            for row in rows
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queues', '0023_search_unaccent'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_daily_stats, migrations.RunPython.noop),
+    ]
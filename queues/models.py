@@ -1,16 +1,22 @@
 from datetime import date, datetime, time, timedelta
-from typing import List, Optional, Tuple, Union
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
 import uuid
 from django.core.validators import MaxValueValidator
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Sum, When
+from django.db.models.functions import Coalesce, TruncDate
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.urls import reverse
 from timezone_field import TimeZoneField
-from webpush import send_user_notification
 
-from users.models import User
+from users.models import User, UserFriend
+
+from . import board, events
+from .schedule import CompiledSchedule
+from .sketch import WaitSketch
 
 WEEKDAY_NAMES = [
     ('monday', _('Monday')),
@@ -27,6 +33,8 @@ FILTER_BOOTSTRAP_ITERATIONS = 10
 # How much the filter favours the memory instead of the new measure
 # should be between 0 and 1 (0=filter uses just the new measure, 1 = filter only uses memory)
 FILTER_MEMORY = 0.8
+# Head tickets tried by call_next before giving up, when other desks keep getting them first
+CALL_NEXT_ATTEMPTS = 5
 
 
 def time_to_secs(x: time) -> int:
@@ -62,6 +70,9 @@ class QueueOpenException(models.Model):
     class Meta:
         verbose_name = _("Opening range exception")
         verbose_name_plural = _("Opening range exceptions")
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'day'], name='queueopenexception_queue_day_unique'),
+        ]
 
     def __str__(self):
         return f"{self.day} {self.from_time} to {self.to_time}"
@@ -79,6 +90,34 @@ class JoinMode(models.TextChoices):
     INVITE = 'INV', _('Invite only')
 
 
+class QQueueQuerySet(models.QuerySet):
+    def bookable_by(self, user: User) -> 'QQueueQuerySet':
+        # Same rules as QQueue.can_user_book, as a single predicate (no query per queue)
+        restricted = [JoinMode.INVITE, JoinMode.FRIENDS_ONLY]
+        if not user.is_authenticated:
+            return self.exclude(join_mode__in=restricted)
+        roles = QueueUser.objects.filter(queue=OuterRef('pk'), user=user)
+        # Users that have `user` as a friend
+        befriended_by = UserFriend.objects.filter(user_to=user).values('user_from')
+        friend_staff = QueueUser.objects\
+            .filter(queue=OuterRef('pk'), user__in=befriended_by)\
+            .exclude(role=QueueUserRole.INVITED)
+        return self.filter(
+            ~Q(join_mode__in=restricted)
+            | Q(join_mode=JoinMode.INVITE) & Q(Exists(roles))
+            | Q(join_mode=JoinMode.FRIENDS_ONLY) & (
+                Q(Exists(roles.filter(role__in=[QueueUserRole.OWNER, QueueUserRole.EMPLOYEE])))
+                | Q(Exists(friend_staff))
+            )
+        )
+
+    def visible_to(self, user: User) -> 'QQueueQuerySet':
+        # Same rules as QQueue.is_visible_by
+        if user.has_perm('queues.manage_reports'):
+            return self.all()
+        return self.bookable_by(user)
+
+
 class QQueue(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(_("Name"), max_length=50)
@@ -98,11 +137,25 @@ class QQueue(models.Model):
     # Number of tickets used to estimate expected_time_per_ticket
     ticket_stats_count = models.IntegerField(_("Ticket status count"), default=0)
     fixed_ticket_time_minutes = models.IntegerField(_("Fixed ticket time (minutes)"), default=None, null=True, blank=True)
+    # Ticket owners get a push reminder this many minutes before their ticket (see the sendreminders command)
+    reminder_minutes = models.PositiveIntegerField(_("Reminder (minutes before)"), default=None, null=True, blank=True)
+
+    # Bumped (see bump_version) every time the queue, its schedule or its tickets change,
+    # used to answer conditional requests without recomputing the response
+    version = models.PositiveBigIntegerField(_("Version"), default=0, editable=False)
+    version_time = models.DateTimeField(_("Version time"), default=timezone.now, editable=False)
+    # Signed into the display board links, incremented to revoke them (see queues.board)
+    board_token_version = models.PositiveIntegerField(_("Board link version"), default=0, editable=False)
+
+    objects = QQueueQuerySet.as_manager()
 
     users = models.ManyToManyField(User, through='QueueUser', verbose_name=_("users"), related_name="queues")
     tickets = models.ManyToManyField(User, through='Ticket', verbose_name=_("tickets"), related_name="tickets")
     reports = models.ManyToManyField(User, through='UserQueueReport', verbose_name=_("reports"), related_name="reported_queues")
 
+    # Updated in place with F() expressions, see save
+    COUNTER_FIELDS = ('version', 'version_time', 'expected_time_per_ticket', 'ticket_stats_count', 'board_token_version')
+
     class Meta:
         verbose_name = _("Queue")
         verbose_name_plural = _("Queues")
@@ -110,15 +163,51 @@ class QQueue(models.Model):
     def __str__(self) -> str:
         return f"{self.name} ({self.join_mode})"
 
-    def is_open_at(self, dt: datetime) -> bool:
-        exception = self.exc_schedule.filter(day=dt.date()).first()
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._saved_reminder_minutes = self.__dict__.get('reminder_minutes')
+
+    def save(self, *args, **kwargs):
+        # The version and the wait statistics only move through bump_version and on_wait_time,
+        # a stale instance must not write them back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in QQueue.COUNTER_FIELDS
+            ]
+        reschedule = not self._state.adding and self.reminder_minutes != self._saved_reminder_minutes
+        super().save(*args, **kwargs)
+        if reschedule:
+            self.reschedule_reminders()
+        self._saved_reminder_minutes = self.reminder_minutes
+        QQueue.bump_version(self.id)
+
+    def reschedule_reminders(self):
+        # Moves the reminders of the future tickets that were not reminded yet
+        tickets = self.tickets_set\
+            .filter(state=TicketState.OPEN, requested_time__gt=timezone.now())\
+            .exclude(notifications_set__kind=NotificationKind.REMINDER)
+        if self.reminder_minutes is None:
+            tickets.update(remind_time=None)
+        else:
+            tickets.update(remind_time=F('requested_time') - timedelta(minutes=self.reminder_minutes))
+
+    @staticmethod
+    def bump_version(queue_id, **counters):
+        # counters: other COUNTER_FIELDS updated in the same statement (e.g. wait_time_counters)
+        QQueue.objects.filter(id=queue_id).update(version=F('version') + 1, version_time=timezone.now(), **counters)
 
-        if exception is not None:
-            return exception.is_open_at(dt.time())
+    def rotate_board_token(self):
+        # The display board links given so far stop working, the manage page shows a new one
+        QQueue.bump_version(self.id, board_token_version=F('board_token_version') + 1)
+        self.refresh_from_db(fields=['version', 'version_time', 'board_token_version'])
+        board.on_queue_changed(self.id)
 
-        day_range = self.schedule.filter(day=dt.weekday()).first()
+    def get_schedule(self, since: Optional[date]=None) -> CompiledSchedule:
+        return CompiledSchedule.get(self.id, since)
 
-        return day_range is not None and day_range.is_open_at(dt.time())
+    def is_open_at(self, dt: datetime) -> bool:
+        return self.get_schedule(dt.date()).is_open_at(dt)
 
     def get_user_role(self, user: User) -> Optional['QueueUserRole']:
         if not user.is_authenticated:
@@ -126,6 +215,7 @@ class QQueue(models.Model):
         uset = self.users_set.filter(user=user).first()
         return None if uset is None else uset.role
 
+    # Keep is_visible_by and can_user_book in sync with QQueueQuerySet.visible_to and bookable_by
     def is_visible_by(self, user: User) -> bool:
         if user.has_perm('queues.manage_reports'):
             return True
@@ -147,14 +237,35 @@ class QQueue(models.Model):
         return True
 
     def get_open_range(self, day: date) -> Optional[Tuple[time, time]]:
-        exception = self.exc_schedule.filter(day=day).first()
-        if exception is not None:
-            return (exception.from_time, exception.to_time) if exception.from_time is not None else None
+        return self.get_schedule(day).get_open_range(day)
 
-        schedule = self.schedule.filter(day=day.weekday()).first()
-        if schedule is None:
-            return None
-        return (schedule.from_time, schedule.to_time)
+    def get_service_state(self, now: datetime) -> Tuple[str, Optional[Tuple[time, time]]]:
+        # State of the queue's day at now (in the queue's timezone) and its opening range, one of
+        # never_open, not_open_yet, open or closed
+        open_range = self.get_open_range(now.date())
+        if open_range is None:
+            state = 'never_open'
+        elif datetime.combine(now.date(), open_range[0], self.tz) > now:
+            state = 'not_open_yet'
+        elif datetime.combine(now.date(), open_range[1], self.tz) < now:
+            state = 'closed'
+        else:
+            state = 'open'
+        return state, open_range
+
+    def get_day_bounds(self, day: date) -> Tuple[datetime, datetime]:
+        # [start, end) of the day in the queue's timezone, lets the database use a range scan
+        # on requested_time instead of computing its date for every row
+        return (
+            datetime.combine(day, time.min, self.tz),
+            datetime.combine(day + timedelta(days=1), time.min, self.tz),
+        )
+
+    def get_open_tickets(self, day: date) -> models.QuerySet:
+        start, end = self.get_day_bounds(day)
+        return self.tickets_set\
+            .filter(state=TicketState.OPEN, requested_time__gte=start, requested_time__lt=end)\
+            .order_by('requested_time', 'id')
 
     def on_wait_time(self, wait_time_secs: int, commit: bool=True):
         # Use average for the first 10 values, and use a very very simple statistical filter
@@ -172,23 +283,186 @@ class QQueue(models.Model):
         self.ticket_stats_count = count + 1
 
         if commit:
-            self.save()
+            # The expected wait is shown on the queue page, it bumps the version
+            QQueue.bump_version(self.id, **QQueue.wait_time_counters(wait_time_secs))
+
+    @staticmethod
+    def wait_time_counters(wait_time_secs: int) -> Dict[str, Any]:
+        # Same filter as on_wait_time computed by the database, so that concurrent desks never lose an update
+        ett = F('expected_time_per_ticket')
+        count = F('ticket_stats_count')
+        return {
+            'expected_time_per_ticket': Case(
+                When(ticket_stats_count__lt=FILTER_BOOTSTRAP_ITERATIONS, then=(ett * count + wait_time_secs) / (count + 1)),
+                default=ett * FILTER_MEMORY + (1 - FILTER_MEMORY) * wait_time_secs,
+                output_field=models.FloatField(),
+            ),
+            'ticket_stats_count': count + 1,
+        }
+
+    @transaction.atomic
+    def close_day(self, day: date, message: str, keep: Optional[Tuple[time, time]]=None, now: Optional[datetime]=None) -> int:
+        """
+        Cancels the open tickets of a day (only the ones out of the `keep` opening hours, if given) and returns how many.
+
+        Works in bulk: one UPDATE for the tickets, one for the daily statistics and one INSERT for the
+        notifications of their owners, however many tickets there are.
+        """
+        if now is None:
+            now = timezone.now()
+        start, end = self.get_day_bounds(day)
+        tickets = self.tickets_set.filter(state=TicketState.OPEN, requested_time__gte=start, requested_time__lt=end)
+        slots = self.slots_set.filter(day=day)
+        if keep is not None:
+            # Tickets without a time (at midnight) are for the whole day, they are kept as well
+            keep_start, keep_end = (datetime.combine(day, x, self.tz) for x in keep)
+            tickets = tickets.exclude(requested_time__gte=keep_start, requested_time__lt=keep_end).exclude(requested_time=start)
+            slots = slots.exclude(start__gte=keep_start, start__lt=keep_end).exclude(start=start)
+        closing = list(tickets.select_for_update().values_list('id', 'user_id'))
+        if not closing:
+            return 0
+
+        slots.delete()
+        n = tickets.update(
+            state=TicketState.QUEUE_CANCELLED,
+            closure_time=now,
+            cancel_message=message,
+            remind_time=None,
+        )
+        QueueDailyStats.add(self.id, day, open=-n, canceled_queue=n)
+        Notification.objects.bulk_create([
+            Notification(
+                user_id=user_id,
+                ticket_id=ticket_id,
+                kind=NotificationKind.CANCELLED,
+                payload={
+                    'head': f'{self.name} is closed',
+                    'body': message,
+                    'url': reverse('queues:ticket_details', args=[ticket_id]),
+                },
+                ttl=24 * 60 * 60,
+            )
+            for ticket_id, user_id in closing
+        ], ignore_conflicts=True)
+        QQueue.bump_version(self.id)
+        board.on_queue_changed(self.id)
+        events.publish(self.id, 'cancelled', [
+            {'id': ticket_id, 'state': TicketState.QUEUE_CANCELLED} for ticket_id, user_id in closing
+        ])
+        return n
+
+    def expire_stale_tickets(self, now: Optional[datetime]=None, state: Optional[str]=None, message: Optional[str]=None, chunk_size: int=500) -> int:
+        """
+        Closes the tickets left open on the days before today (in the queue's timezone), returns how many.
+
+        Works in chunks of bulk updates, each in its own transaction, so that the sweep never holds
+        locks for long. `state` can be any closed state (e.g. QUEUE_CANCELLED with a message), EXPIRED by default.
+        """
+        if now is None:
+            now = timezone.now()
+        if state is None:
+            state = TicketState.EXPIRED
+        today_start = self.get_day_bounds(now.astimezone(self.tz).date())[0]
+        stale = self.tickets_set.filter(state=TicketState.OPEN, requested_time__lt=today_start)
+        total = 0
+        while True:
+            with transaction.atomic():
+                chunk = list(stale.order_by('requested_time').select_for_update().values_list('id', 'requested_time')[:chunk_size])
+                if not chunk:
+                    break
+                ids = [x[0] for x in chunk]
+                n = Ticket.objects.filter(id__in=ids, state=TicketState.OPEN).update(
+                    state=state,
+                    closure_time=now,
+                    cancel_message=message,
+                    remind_time=None,
+                )
+                # Where the lock above is a no-op (SQLite), a ticket of the chunk may have been closed
+                # in between: the statistics only count the rows this update closed
+                closed = list(Ticket.objects
+                    .filter(id__in=ids, state=state, closure_time=now)
+                    .values_list('id', 'requested_time'))
+                closed_ids = [x[0] for x in closed]
+                TicketSlot.objects.filter(ticket_id__in=closed_ids).delete()
+                days = defaultdict(int)
+                for ticket_id, requested_time in closed:
+                    days[requested_time.astimezone(self.tz).date()] += 1
+                for day, count in days.items():
+                    QueueDailyStats.add(self.id, day, **{'open': -count, QueueDailyStats.STATE_FIELDS[state]: count})
+                events.publish(self.id, TICKET_EVENTS[state], [{'id': ticket_id, 'state': state} for ticket_id in closed_ids])
+                total += n
+        if total > 0:
+            QQueue.bump_version(self.id)
+        return total
+
+    @transaction.atomic
+    def call_next(self, now: Optional[datetime]=None) -> Optional['Ticket']:
+        """
+        Serves the ticket at the head of the line and returns it (None if nobody is waiting).
+
+        Several desks can call this concurrently: where the database supports it, the head
+        ticket is locked with SKIP LOCKED so that other desks move on to the next one, and
+        the ticket is closed with a conditional update, so it is never served twice.
+
+        The rows shared by the desks (the day's statistics and the queue's counters) are written
+        in the same transaction, after the ticket, with single UPDATE statements using F()
+        expressions: another desk only waits for the end of this short transaction, and no
+        update is ever lost.
+        """
+        if now is None:
+            now = timezone.now()
+        tickets = self.get_open_tickets(now.astimezone(self.tz).date())
+        if connection.features.has_select_for_update_skip_locked:
+            # NO KEY: the notification of the next ticket references it (a KEY SHARE lock)
+            tickets = tickets.select_for_update(skip_locked=True, no_key=connection.features.has_select_for_no_key_update)
+        for _ in range(CALL_NEXT_ATTEMPTS):
+            ticket = tickets.first()
+            if ticket is None:
+                return None
+            ticket.queue = self
+            try:
+                with transaction.atomic():
+                    ticket.serve(now=now)
+                return ticket
+            except TicketStateError:
+                # Another desk got it first
+                continue
+        return None
 
     def get_bookable_times(self, day: date, now: Optional[datetime]=None) -> None | Tuple[time, time] | List[Tuple[time, time]]:
+        return self.get_bookable_times_range(day, day, now)[day]
+
+    def get_bookable_times_range(self, start: date, end: date, now: Optional[datetime]=None) -> Dict[date, None | Tuple[time, time] | List[Tuple[time, time]]]:
+        # Same as get_bookable_times, but for every day between start and end (inclusive).
+        # Occupied slots are fetched once for the whole range.
         if now is None:
             now = datetime.now(tz=self.tz)
 
+        schedule = self.get_schedule(start)
+        slots = defaultdict(list)
+        if self.fixed_ticket_time_minutes is not None:
+            for day, slot_start in self.slots_set.filter(day__range=(start, end)).order_by('start').values_list('day', 'start'):
+                slots[day].append(time_to_secs(slot_start.astimezone(self.tz).time()))
+
+        res = {}
+        for i in range((end - start).days + 1):
+            day = start + timedelta(days=i)
+            res[day] = self._compute_bookable_times(day, schedule.get_open_range(day), slots[day], now)
+        return res
+
+    def _compute_bookable_times(self, day: date, open_range: Optional[Tuple[time, time]], tickets: List[int], now: datetime) -> None | Tuple[time, time] | List[Tuple[time, time]]:
+        # tickets: sorted start (in seconds, queue's timezone) of the occupied slots
         if datetime.combine(day, time.max, self.tz) < now:
             return None # Can't book in the past
 
-        open_range = self.get_open_range(day)
         if open_range is None:
             return None
         ticket_secs = self.fixed_ticket_time_minutes
         if ticket_secs is None:
             # There's no fixed ticket time, you can use any time between x and y
             # (any time in the future!)
-            open_range = (secs_to_time(max(time_to_secs(open_range[0]), time_to_secs(now.time()))), open_range[1])
+            if day == now.date():
+                open_range = (secs_to_time(max(time_to_secs(open_range[0]), time_to_secs(now.time()))), open_range[1])
             return open_range
         ticket_secs = ticket_secs * 60
         # Split time in ranges of self.fixed_ticket_time_minutes
@@ -197,7 +471,6 @@ class QQueue(models.Model):
         end_time = time_to_secs(open_range[1])
         itime = start_time
 
-        tickets = list(self.tickets_set.filter(requested_time__date=day, state=TicketState.OPEN).order_by('requested_time'))
         iticket = 0
 
         def time_to_local(t: time) -> time:
@@ -211,10 +484,10 @@ class QQueue(models.Model):
                 itime += ticket_secs
                 continue
 
-            while iticket < len(tickets) and time_to_secs(tickets[iticket].requested_time.astimezone(self.tz).time()) <= itime - ticket_secs:
+            while iticket < len(tickets) and tickets[iticket] <= itime - ticket_secs:
                 iticket += 1
 
-            is_time_used = iticket < len(tickets) and (itime <= time_to_secs(tickets[iticket].requested_time.astimezone(self.tz).time()) < itime + ticket_secs)
+            is_time_used = iticket < len(tickets) and (itime <= tickets[iticket] < itime + ticket_secs)
             if not is_time_used:
                 res.append((
                     time_to_local(current),
@@ -245,6 +518,16 @@ class QueueUser(models.Model):
         default=QueueUserRole.OWNER,
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'user'], name='queueuser_queue_user_unique'),
+        ]
+
+
+class TicketStateError(Exception):
+    # The ticket is not in a state that allows the transition (e.g. it was already served)
+    pass
+
 
 class TicketState(models.TextChoices):
     OPEN = 'OPE', _('Open')
@@ -254,6 +537,17 @@ class TicketState(models.TextChoices):
     QUEUE_CANCELLED = 'QCA', _('Cancelled by a queue operator')
     # Served correctly
     SERVED = 'SER', _('Served')
+    # Never served nor cancelled, closed by the sweeptickets command once its day is over
+    EXPIRED = 'EXP', _('Expired')
+
+
+# Event sent on the queue's stream when a ticket gets to a state
+TICKET_EVENTS = {
+    TicketState.SERVED: 'served',
+    TicketState.USER_CANCELLED: 'cancelled',
+    TicketState.QUEUE_CANCELLED: 'cancelled',
+    TicketState.EXPIRED: 'expired',
+}
 
 
 class Ticket(models.Model):
@@ -272,15 +566,32 @@ class Ticket(models.Model):
     closure_time = models.DateTimeField(verbose_name=_("Closure time"), default=None, null=True)
     wait_time_secs = models.IntegerField(verbose_name=_("Wait time"), default=None, null=True)
     cancel_message = models.CharField(verbose_name=_("Closure message"), max_length=128, default=None, null=True)
+    # When the reminder is due, cleared once it is queued (or when the ticket closes)
+    remind_time = models.DateTimeField(verbose_name=_("Reminder time"), default=None, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Due reminders, only the pending ones are indexed
+            models.Index(fields=['remind_time'], name='ticket_remind_idx', condition=Q(remind_time__isnull=False)),
+            # Open tickets of a queue in a time range (manage page, head of the queue, ...)
+            models.Index(fields=['queue', 'state', 'requested_time'], name='ticket_queue_state_time_idx'),
+            # Every ticket of a queue in a time range (statistics)
+            models.Index(fields=['queue', 'requested_time'], name='ticket_queue_time_idx'),
+            # Tickets of a user, by time
+            models.Index(fields=['user', 'requested_time'], name='ticket_user_time_idx'),
+        ]
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self._is_cleaned = False
+        # Last saved (state, requested_time, wait_time_secs), used to keep the daily statistics up to date.
+        # Read from __dict__ so that deferred fields are not loaded
+        self._saved = None if self.pk is None else self._stats_key(self.__dict__)
 
     @transaction.atomic
     def serve(self, commit: bool=True, now: Optional[datetime]=None):
         if self.state != TicketState.OPEN:
-            raise Exception("Invalid ticket state")
+            raise TicketStateError("Invalid ticket state")
 
         if now is None:
             now = timezone.now()
@@ -295,26 +606,26 @@ class Ticket(models.Model):
 
         if fromt is None:
             self.wait_time_secs = None
-            self.save()
-            self.try_check_next_notification()
-            return
-
-        if fromt > now:
+        elif fromt > now:
             self.wait_time_secs = 0
         else:
             diff = now - fromt
             assert(diff.days <= 0)
             self.wait_time_secs = diff.seconds
 
-        # Update statistics
-        self.queue.on_wait_time(self.wait_time_secs)
+        # Update statistics, written with the version bump of the closure
+        counters = {}
+        if self.wait_time_secs is not None:
+            self.queue.on_wait_time(self.wait_time_secs, commit=False)
+            counters = QQueue.wait_time_counters(self.wait_time_secs)
         if commit:
-            self.save()
+            self._close(counters)
         self.try_check_next_notification()
 
+    @transaction.atomic
     def cancel(self, by_whom: Union['user', 'queue'], message: str, commit: bool=True, now: Optional[datetime]=None):
         if self.state != TicketState.OPEN:
-            raise Exception("Invalid ticket state")
+            raise TicketStateError("Invalid ticket state")
 
         if now is None:
             now = timezone.now()
@@ -322,48 +633,391 @@ class Ticket(models.Model):
         self.closure_time = now
         self.cancel_message = message
         if commit:
-            self.save()
+            self._close()
         self.try_check_next_notification()
 
+    @transaction.atomic
+    def reschedule(self, requested_time: datetime):
+        # Moves an open ticket, only the new slot is validated
+        if self.state != TicketState.OPEN:
+            raise TicketStateError("Invalid ticket state")
+        self.requested_time = requested_time
+        self._is_cleaned = False
+        self.save(update_fields=['requested_time', 'remind_time'])
+
+    def _close(self, counters: Optional[Dict[str, Any]]=None):
+        # Writes the closure only if the ticket is still open in the database: when two desks
+        # race on the same ticket, one of them gets TicketStateError instead of closing it twice
+        self.remind_time = None
+        closed = Ticket.objects.filter(id=self.id, state=TicketState.OPEN).update(
+            state=self.state,
+            closure_time=self.closure_time,
+            wait_time_secs=self.wait_time_secs,
+            cancel_message=self.cancel_message,
+            remind_time=None,
+        )
+        if not closed:
+            raise TicketStateError("Invalid ticket state")
+        self._on_saved(counters)
+
     def try_check_next_notification(self):
-        next_ticket = self.queue.tickets_set\
-            .filter(requested_time__date=date.today(), state=TicketState.OPEN)\
-            .order_by('requested_time')\
+        # Head of the line, and whether it was already told (a single query)
+        next_ticket = self.queue.get_open_tickets(datetime.now(self.queue.tz).date())\
+            .annotate(notified=Exists(Notification.objects.filter(ticket=OuterRef('pk'), kind=NotificationKind.NEXT)))\
+            .only('id', 'queue_id', 'user_id')\
             .first()
         # Send ticket to the next in the queue
-        if next_ticket is not None:
+        if next_ticket is not None and not next_ticket.notified:
             payload = {
-                'head': f'Go to {next_ticket.queue.name}',
-                'body': f'Queue {next_ticket.queue.name} is free!',
+                'head': f'Go to {self.queue.name}',
+                'body': f'Queue {self.queue.name} is free!',
                 'url': reverse('queues:ticket_details', args=[next_ticket.id]),
             }
-            send_user_notification(user=next_ticket.user, payload=payload, ttl=1000)
+            # Delivered later by the sendnotifications worker, only if this transaction commits
+            Notification.notify(next_ticket, NotificationKind.NEXT, payload, ttl=1000)
 
 
     def clean(self):
         # Check that this ticket does not collide
         if self.state == TicketState.OPEN and self.queue.fixed_ticket_time_minutes is not None:
-            open_day = self.queue.get_open_range(self.requested_time.date())
-            if (time_to_secs(self.requested_time.time()) - time_to_secs(open_day[0])) % (self.queue.fixed_ticket_time_minutes * 60) != 0:
+            open_day = self.queue.get_open_range(self.get_day())
+            local_time = self.requested_time.astimezone(self.queue.tz).time()
+            if (time_to_secs(local_time) - time_to_secs(open_day[0])) % (self.queue.fixed_ticket_time_minutes * 60) != 0:
                 raise ValidationError("Ticket time is not aligned to queue's fixed slots")
 
-            # https://stackoverflow.com/questions/100210/what-is-the-standard-way-to-add-n-seconds-to-datetime-time-in-python
-            # This seems to be the, uhm, "pythonic" way to add times(?)
-            end_time = (datetime.combine(date.today(), self.requested_time.time()) + timedelta(minutes=self.queue.fixed_ticket_time_minutes)).time()
-            q = self.queue.tickets_set.filter(
-                requested_time__date=self.requested_time.date(),
-                requested_time__time__gte=self.requested_time.time(),
-                requested_time__time__lt=end_time,
-                state=TicketState.OPEN,
-            ).first()
-            if q is not None and q.id != self.id:
+            end_time = self.requested_time + timedelta(minutes=self.queue.fixed_ticket_time_minutes)
+            q = self.queue.slots_set.filter(
+                day=self.get_day(),
+                start__gte=self.requested_time,
+                start__lt=end_time,
+            )
+            if self.id is not None:
+                q = q.exclude(ticket_id=self.id)
+            if q.exists():
                 raise ValidationError("Ticket time slot already booked")
         self._is_cleaned = True
 
-    def save(self):
-        if not self._is_cleaned:
+    def get_day(self) -> date:
+        # Day of the ticket, as seen from the queue's timezone
+        return self.requested_time.astimezone(self.queue.tz).date()
+
+    def get_remind_time(self) -> Optional[datetime]:
+        minutes = self.queue.reminder_minutes
+        if self.state != TicketState.OPEN or minutes is None or self.requested_time is None:
+            return None
+        return self.requested_time - timedelta(minutes=minutes)
+
+    def _slot_changed(self) -> bool:
+        # Whether the ticket takes a (different) slot since it was last saved
+        if self.state != TicketState.OPEN:
+            return False
+        return self._saved is None or self._saved[0] != TicketState.OPEN or self._saved[1] != self.requested_time
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        # The slot is only validated when it changes, a state change does not need to
+        if not self._is_cleaned and self._slot_changed():
             self.clean()
-        return super().save()
+        if self.state != TicketState.OPEN:
+            self.remind_time = None
+        elif self._saved is None or self._saved[1] != self.requested_time:
+            self.remind_time = self.get_remind_time()
+        res = super().save(*args, **kwargs)
+        self._on_saved()
+        return res
+
+    def _on_saved(self, counters: Optional[Dict[str, Any]]=None):
+        # Keeps the derived data in sync after the ticket row is written. counters are written
+        # with the version bump, last: the queue row (shared by every ticket of the queue) is
+        # locked until the end of the transaction
+        event_type = self._event_type()
+        self._sync_slot()
+        for day, (deltas, waits) in self._stats_changes().items():
+            QueueDailyStats.add(self.queue_id, day, waits=waits, **deltas)
+        QQueue.bump_version(self.queue_id, **(counters or {}))
+        if event_type is not None:
+            board.on_queue_changed(self.queue_id)
+            events.publish(self.queue_id, event_type, [self.to_event()])
+
+    def _event_type(self) -> Optional[str]:
+        # What the last save did to the ticket, as announced on the queue's event stream
+        was_open = self._saved is not None and self._saved[0] == TicketState.OPEN
+        if self.state != TicketState.OPEN:
+            return TICKET_EVENTS.get(self.state) if was_open else None
+        if not was_open:
+            return 'created'
+        return 'moved' if self._saved[1] != self.requested_time else None
+
+    def to_event(self) -> dict:
+        res = {
+            'id': self.id,
+            'state': self.state,
+            'time': self.requested_time.isoformat(),
+            # As shown by the manage page
+            'day': self.get_day().isoformat(),
+            'localTime': self.requested_time.astimezone(self.queue.tz).strftime('%H:%M'),
+        }
+        # Only when it is at hand, events never cost a query
+        if self._meta.get_field('user').is_cached(self):
+            res['user'] = {
+                'id': self.user.id,
+                'firstName': self.user.first_name,
+                'lastName': self.user.last_name,
+                'pronouns': self.user.pronouns,
+                'image': self.user.image.url if self.user.image else None,
+            }
+        return res
+
+    def _sync_slot(self):
+        # Only open tickets occupy their slot, closing a ticket frees it
+        was_open = self._saved is not None and self._saved[0] == TicketState.OPEN
+        if self.state != TicketState.OPEN:
+            if was_open:
+                TicketSlot.objects.filter(ticket=self).delete()
+        elif not was_open:
+            TicketSlot.objects.create(ticket=self, queue_id=self.queue_id, day=self.get_day(), start=self.requested_time)
+        elif self._saved[1] != self.requested_time:
+            TicketSlot.objects.filter(ticket=self).update(day=self.get_day(), start=self.requested_time)
+
+
+    @staticmethod
+    def _stats_key(fields: dict) -> Tuple[Optional[str], Optional[datetime], Optional[int]]:
+        return (fields.get('state'), fields.get('requested_time'), fields.get('wait_time_secs'))
+
+    def _stats_changes(self) -> Dict[date, Tuple[Dict[str, int], Dict[int, int]]]:
+        # Rollup changes since the last save: removes the old contribution and adds the new one,
+        # (counter deltas, waits) for every day touched
+        old, new = self._saved, self._stats_key(self.__dict__)
+        self._saved = new
+        if old == new:
+            return {}
+        changes: Dict[date, Tuple[Dict[str, int], Dict[int, int]]] = {}
+        def contribute(day: date, state: str, wait_time_secs: Optional[int], sign: int):
+            deltas, waits = changes.setdefault(day, ({}, {}))
+            for k, v in QueueDailyStats.deltas(state, wait_time_secs, sign).items():
+                deltas[k] = deltas.get(k, 0) + v
+            if state == TicketState.SERVED and wait_time_secs is not None:
+                waits[wait_time_secs] = waits.get(wait_time_secs, 0) + sign
+
+        if old is not None and old[0] is not None and old[1] is not None:
+            contribute(old[1].astimezone(self.queue.tz).date(), old[0], old[2], -1)
+        contribute(self.get_day(), new[0], new[2], 1)
+        return changes
+
+
+class TicketSlot(models.Model):
+    """
+    Occupancy index of the open tickets.
+
+    Holds a row for every OPEN ticket, kept in sync by Ticket.save, so that availability
+    and collision checks only look at live reservations instead of the whole ticket history.
+    """
+    ticket = models.OneToOneField(Ticket, verbose_name=_("ticket"), related_name="slot", primary_key=True, on_delete=models.CASCADE)
+    queue = models.ForeignKey(QQueue, verbose_name=_("queue"), related_name="slots_set", on_delete=models.CASCADE)
+    # Day of the slot in the queue's timezone
+    day = models.DateField(verbose_name=_("day"))
+    start = models.DateTimeField(verbose_name=_("start"))
+
+    class Meta:
+        verbose_name = _("Ticket slot")
+        verbose_name_plural = _("Ticket slots")
+        indexes = [
+            models.Index(fields=['queue', 'day', 'start'], name='ticketslot_queue_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.queue_id} {self.start}"
+
+class QueueDailyStats(models.Model):
+    """
+    Per-day rollup of the tickets of a queue, used by the statistics page.
+
+    Rows are updated incrementally every time a ticket is saved, the rebuildstats command
+    recomputes them from the tickets table.
+    """
+    queue = models.ForeignKey(QQueue, verbose_name=_("queue"), related_name="daily_stats", on_delete=models.CASCADE)
+    # Day of the tickets in the queue's timezone
+    day = models.DateField(verbose_name=_("day"))
+
+    served = models.IntegerField(verbose_name=_("Served"), default=0)
+    canceled_queue = models.IntegerField(verbose_name=_("Cancelled by the queue"), default=0)
+    canceled_user = models.IntegerField(verbose_name=_("Cancelled by the user"), default=0)
+    open = models.IntegerField(verbose_name=_("Open"), default=0)
+    expired = models.IntegerField(verbose_name=_("Expired"), default=0)
+    # Only served tickets have a wait time
+    wait_sum = models.BigIntegerField(verbose_name=_("Wait time sum"), default=0)
+    wait_count = models.IntegerField(verbose_name=_("Wait time count"), default=0)
+    # Wait time distribution, see WaitSketch.to_json
+    wait_sketch = models.JSONField(verbose_name=_("Wait time sketch"), default=dict)
+
+    STATE_FIELDS = {
+        TicketState.OPEN: 'open',
+        TicketState.SERVED: 'served',
+        TicketState.QUEUE_CANCELLED: 'canceled_queue',
+        TicketState.USER_CANCELLED: 'canceled_user',
+        TicketState.EXPIRED: 'expired',
+    }
+
+    class Meta:
+        verbose_name = _("Daily statistics")
+        verbose_name_plural = _("Daily statistics")
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'day'], name='queuedailystats_queue_day_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.queue_id} {self.day}"
+
+    @property
+    def avg_wait(self) -> float:
+        return self.wait_sum / self.wait_count if self.wait_count > 0 else 0
+
+    @classmethod
+    def deltas(cls, state: str, wait_time_secs: Optional[int], sign: int) -> Dict[str, int]:
+        # Contribution of a single ticket to its day (sign=-1 to remove it)
+        res = {cls.STATE_FIELDS[state]: sign}
+        if state == TicketState.SERVED and wait_time_secs is not None:
+            res['wait_sum'] = sign * wait_time_secs
+            res['wait_count'] = sign
+        return res
+
+    @classmethod
+    def add(cls, queue_id, day: date, waits: Optional[Dict[int, int]]=None, **deltas: int):
+        """
+        Adds the deltas to the counters of a day, and the waits (wait time -> count, negative to remove)
+        to its sketch.
+
+        Counters are updated with F() expressions, the sketch (a JSON document) needs the row to be locked.
+        """
+        updates = {k: F(k) + v for k, v in deltas.items() if v != 0}
+        waits = {k: v for k, v in (waits or {}).items() if v != 0}
+        if waits:
+            with transaction.atomic(savepoint=False):
+                row = cls.objects.select_for_update().filter(queue_id=queue_id, day=day).only('id', 'wait_sketch').first()
+                if row is not None:
+                    sketch = row.get_wait_sketch()
+                    for wait_time_secs, count in waits.items():
+                        sketch.add(wait_time_secs, count)
+                    cls.objects.filter(id=row.id).update(wait_sketch=sketch.to_json(), **updates)
+                    return
+        elif not updates:
+            return
+        elif cls.objects.filter(queue_id=queue_id, day=day).update(**updates) > 0:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    queue_id=queue_id,
+                    day=day,
+                    wait_sketch=WaitSketch.of(w for w, count in waits.items() for _ in range(count)).to_json(),
+                    **deltas,
+                )
+        except IntegrityError:
+            # Someone else created the row in the meantime
+            cls.add(queue_id, day, waits=waits, **deltas)
+
+    def get_wait_sketch(self) -> WaitSketch:
+        return WaitSketch.from_json(self.wait_sketch)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls, queue: QQueue):
+        # Recompute all of the rollups of a queue from its tickets, and bump its version so that
+        # clients don't keep the statistics they had before (see stats_views.api_query)
+        served = Q(state=TicketState.SERVED)
+        rows = queue.tickets_set\
+            .annotate(day=TruncDate('requested_time', tzinfo=queue.tz))\
+            .values('day')\
+            .annotate(
+                served=Count('id', filter=served),
+                canceled_queue=Count('id', filter=Q(state=TicketState.QUEUE_CANCELLED)),
+                canceled_user=Count('id', filter=Q(state=TicketState.USER_CANCELLED)),
+                open=Count('id', filter=Q(state=TicketState.OPEN)),
+                expired=Count('id', filter=Q(state=TicketState.EXPIRED)),
+                wait_sum=Coalesce(Sum('wait_time_secs', filter=served), 0),
+                wait_count=Count('wait_time_secs', filter=served),
+            )\
+            .order_by('day')
+
+        sketches = defaultdict(WaitSketch)
+        waits = queue.tickets_set\
+            .filter(state=TicketState.SERVED, wait_time_secs__isnull=False)\
+            .values_list('requested_time', 'wait_time_secs')
+        for requested_time, wait_time_secs in waits.iterator():
+            sketches[requested_time.astimezone(queue.tz).date()].add(wait_time_secs)
+
+        queue.daily_stats.all().delete()
+        cls.objects.bulk_create(
+            cls(queue=queue, wait_sketch=sketches[row['day']].to_json(), **row)
+            for row in rows
+        )
+        QQueue.bump_version(queue.id)
+
+
+class NotificationState(models.TextChoices):
+    PENDING = 'PEN', _('Pending')
+    SENT = 'SEN', _('Sent')
+    # Gave up after too many attempts
+    FAILED = 'FAI', _('Failed')
+
+
+class NotificationKind(models.TextChoices):
+    # The ticket is at the head of the line
+    NEXT = 'NXT', _('Next in line')
+    # The ticket is about to start (see QQueue.reminder_minutes)
+    REMINDER = 'REM', _('Reminder')
+    # The queue cancelled the ticket (see QQueue.close_day)
+    CANCELLED = 'CAN', _('Cancelled')
+
+
+class Notification(models.Model):
+    """
+    Outbox of the web push notifications.
+
+    Notifications are written in the same transaction as the change that causes them,
+    and delivered (with retries) by the sendnotifications command.
+    """
+    user = models.ForeignKey(User, verbose_name=_("user"), related_name="notifications_set", on_delete=models.CASCADE)
+    # (ticket, kind) is the idempotency key: a ticket gets each kind of notification at most once
+    ticket = models.ForeignKey(Ticket, verbose_name=_("ticket"), related_name="notifications_set", on_delete=models.CASCADE, null=True, default=None)
+    kind = models.CharField(max_length=3, choices=NotificationKind.choices, null=True, default=None)
+    payload = models.JSONField(verbose_name=_("Payload"))
+    ttl = models.IntegerField(verbose_name=_("Time to live"), default=0)
+
+    creation_time = models.DateTimeField(verbose_name=_("Creation date"), auto_now_add=True)
+    state = models.CharField(
+        max_length=3,
+        choices=NotificationState.choices,
+        default=NotificationState.PENDING,
+    )
+    next_attempt_time = models.DateTimeField(verbose_name=_("Next attempt"), default=timezone.now)
+    attempts = models.IntegerField(verbose_name=_("Attempts"), default=0)
+    sent_time = models.DateTimeField(verbose_name=_("Sent time"), default=None, null=True)
+    last_error = models.CharField(verbose_name=_("Last error"), max_length=256, default=None, null=True)
+    # Ids of the subscriptions already reached (or gone), retries only go to the other ones
+    delivered_to = models.JSONField(verbose_name=_("Delivered to"), default=list)
+
+    class Meta:
+        verbose_name = _("Notification")
+        verbose_name_plural = _("Notifications")
+        indexes = [
+            models.Index(fields=['state', 'next_attempt_time'], name='notification_due_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['ticket', 'kind'], name='notification_ticket_kind_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.payload.get('head')} ({self.state})"
+
+    @classmethod
+    def notify(cls, ticket: Ticket, kind: NotificationKind, payload: dict, ttl: int=0):
+        # Queues the notification unless the ticket already got one of this kind (a single INSERT ... ON CONFLICT)
+        cls.objects.bulk_create(
+            [cls(user_id=ticket.user_id, ticket=ticket, kind=kind, payload=payload, ttl=ttl)],
+            ignore_conflicts=True,
+        )
+
 
 class UserQueueReport(models.Model):
     queue = models.ForeignKey(QQueue, verbose_name=_("queue"), related_name="reports_set", on_delete=models.CASCADE)
@@ -378,3 +1032,66 @@ class UserQueueReport(models.Model):
             ("manage_reports", "Can view and review submitted reports"),
             ("view_all_stats", "Can view stats of queues they do not own"),
         ]
+
+
+class WorkerLease(models.Model):
+    """
+    Named lease held by one worker process at a time.
+
+    Lets a job run on several nodes for availability while only one of them is active,
+    the holder has to renew the lease before it expires or another worker takes over.
+    """
+    name = models.CharField(verbose_name=_("Name"), max_length=64, primary_key=True)
+    owner = models.CharField(verbose_name=_("Owner"), max_length=128)
+    expire_time = models.DateTimeField(verbose_name=_("Expiration time"))
+
+    def __str__(self):
+        return f"{self.name} ({self.owner})"
+
+    @classmethod
+    def acquire(cls, name: str, owner: str, duration: timedelta, now: Optional[datetime]=None) -> bool:
+        # Takes or renews the lease, returns False if another owner holds it
+        if now is None:
+            now = timezone.now()
+        expire_time = now + duration
+        if cls.objects.filter(Q(owner=owner) | Q(expire_time__lte=now), name=name).update(owner=owner, expire_time=expire_time):
+            return True
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, owner=owner, expire_time=expire_time)
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def release(cls, name: str, owner: str):
+        cls.objects.filter(name=name, owner=owner).delete()
+
+
+class QueueSearchDocument(models.Model):
+    """
+    Searchable text of a queue, kept in sync by queues.signals.
+
+    Indexed by the database (see queues.search): by the QueueSearchIndex FTS5 table on SQLite,
+    by a tsvector column with a GIN index on PostgreSQL. Both are created by migration 0020.
+    """
+    queue = models.OneToOneField(QQueue, verbose_name=_("queue"), related_name="search_document", on_delete=models.CASCADE)
+    name = models.CharField(_("Name"), max_length=50)
+    description = models.CharField(_("Description"), max_length=1024, default="")
+
+    def __str__(self):
+        return self.name
+
+
+class QueueSearchIndex(models.Model):
+    """
+    FTS5 table over QueueSearchDocument (SQLite only), only used to join the matches of a search.
+    """
+    document = models.OneToOneField(QueueSearchDocument, related_name="index", primary_key=True, db_column='rowid', on_delete=models.DO_NOTHING)
+    # FTS5 hidden columns: the one named after the table is the left side of MATCH, rank is bm25
+    match = models.TextField(db_column='queues_queuesearchindex')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'queues_queuesearchindex'
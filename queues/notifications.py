@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from typing import List, Optional
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Notification, NotificationKind, NotificationState, Ticket
+from .push import PushEngine, get_engine
+
+# Attempts before a notification is marked as failed
+MAX_ATTEMPTS = 8
+# Delay before the first retry, doubled at every failed attempt (up to BACKOFF_MAX)
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=1)
+# How long a worker owns the notifications it picked up
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def backoff(attempts: int) -> timedelta:
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+def claim_due(limit: int, now: datetime) -> List[Notification]:
+    # Postpones the due notifications while they are being delivered, the conditional update
+    # makes sure that two workers never pick up the same notification
+    claimed = []
+    due = Notification.objects\
+        .filter(state=NotificationState.PENDING, next_attempt_time__lte=now)\
+        .order_by('next_attempt_time')[:limit]
+    for n in due:
+        n_claimed = Notification.objects\
+            .filter(id=n.id, state=NotificationState.PENDING, next_attempt_time=n.next_attempt_time)\
+            .update(next_attempt_time=now + CLAIM_TIMEOUT)
+        if n_claimed:
+            claimed.append(n)
+    return claimed
+
+
+def on_delivered(notification: Notification, now: datetime):
+    notification.state = NotificationState.SENT
+    notification.sent_time = now
+    notification.attempts += 1
+    notification.save(update_fields=['state', 'sent_time', 'attempts', 'delivered_to'])
+
+
+def on_failed(notification: Notification, error: Exception, now: datetime):
+    notification.attempts += 1
+    notification.last_error = str(error)[:256]
+    if notification.attempts >= MAX_ATTEMPTS:
+        notification.state = NotificationState.FAILED
+    else:
+        notification.next_attempt_time = now + backoff(notification.attempts)
+    notification.save(update_fields=['attempts', 'last_error', 'state', 'next_attempt_time', 'delivered_to'])
+
+
+def deliver_due(limit: int=100, now: Optional[datetime]=None, engine: Optional[PushEngine]=None) -> int:
+    # Sends the notifications that are due (concurrently), returns how many were handled
+    if now is None:
+        now = timezone.now()
+    if engine is None:
+        engine = get_engine()
+    notifications = claim_due(limit, now)
+    results = engine.send_many((n.user_id, n.payload, n.ttl, set(n.delivered_to)) for n in notifications)
+    for i, n in enumerate(notifications):
+        done, error = results[i]
+        # Devices that got the notification don't get it again when it's retried for the others
+        n.delivered_to = n.delivered_to + done
+        if error is None:
+            on_delivered(n, now)
+        else:
+            on_failed(n, error, now)
+    return len(notifications)
+
+
+def remind_due(limit: int=100, now: Optional[datetime]=None) -> int:
+    # Queues the reminders that are due, returns how many tickets were handled.
+    # The scan only walks the (partial) remind_time index, so it does not depend on how many tickets are booked
+    if now is None:
+        now = timezone.now()
+    due = Ticket.objects\
+        .filter(remind_time__lte=now)\
+        .select_related('queue')\
+        .order_by('remind_time')[:limit]
+    due = list(due)
+    for ticket in due:
+        with transaction.atomic():
+            # Reminders that are only found after the ticket started are dropped
+            if ticket.requested_time > now:
+                minutes = max(round((ticket.requested_time - now).total_seconds() / 60), 1)
+                payload = {
+                    'head': f'{ticket.queue.name} in {minutes} minutes',
+                    'body': f'Your ticket for {ticket.queue.name} starts at {ticket.requested_time.astimezone(ticket.queue.tz).strftime("%H:%M")}',
+                    'url': reverse('queues:ticket_details', args=[ticket.id]),
+                }
+                ttl = int((ticket.requested_time - now).total_seconds())
+                Notification.notify(ticket, NotificationKind.REMINDER, payload, ttl=ttl)
+            # Bypasses Ticket.save, the reminder does not change the slots, the statistics or the queue version
+            Ticket.objects.filter(id=ticket.id, remind_time=ticket.remind_time).update(remind_time=None)
+    return len(due)
@@ -0,0 +1,49 @@
+from datetime import date, datetime, timedelta
+from typing import Optional
+from django.db.models import QuerySet
+from django.utils import timezone
+
+
+def get_line(queue_id, day: date) -> QuerySet:
+    """
+    Slots of the open tickets of a queue on a day, in serving order (requested time, then id, as call_next).
+
+    Read from the (queue, day, start) index of the slots, which Ticket.save keeps in sync with every
+    transition in the same transaction: nothing to cache or invalidate.
+    """
+    from .models import TicketSlot
+
+    return TicketSlot.objects.filter(queue_id=queue_id, day=day).order_by('start', 'ticket_id')
+
+
+def count_ahead(queue_id, day: date, start: datetime, ticket_id: int) -> int:
+    # One COUNT over the range of the index before the ticket, only the slots with the same
+    # start are compared by id
+    return get_line(queue_id, day)\
+        .filter(start__lte=start)\
+        .exclude(start=start, ticket_id__gte=ticket_id)\
+        .count()
+
+
+def get_position(ticket, now: Optional[datetime]=None) -> Optional[dict]:
+    """
+    Position of an open ticket in its day's line and its estimated call time, None if it's closed.
+
+    The estimate counts expected_time_per_ticket for every ticket ahead, and never comes before
+    the requested time.
+    """
+    from .models import TicketState
+
+    if ticket.state != TicketState.OPEN:
+        return None
+    if now is None:
+        now = timezone.now()
+    queue = ticket.queue
+    ahead = count_ahead(queue.id, ticket.get_day(), ticket.requested_time, ticket.id)
+    eta = max(ticket.requested_time, now + timedelta(seconds=ahead * queue.expected_time_per_ticket))
+    return {
+        'position': ahead + 1,
+        'ahead': ahead,
+        'eta': eta,
+        'waitSecs': int((eta - now).total_seconds()) if eta > now else 0,
+    }
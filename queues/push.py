@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+from typing import Collection, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+from django.conf import settings
+from py_vapid import Vapid
+from pywebpush import WebPushException, webpush
+import requests
+from requests.adapters import HTTPAdapter
+from webpush.models import PushInformation, SubscriptionInfo
+
+# VAPID headers are signed to be valid this long and reused until they are about to expire
+VAPID_VALIDITY_SECS = 12 * 60 * 60
+VAPID_RENEW_MARGIN_SECS = 10 * 60
+# Push services answer with these status codes when a subscription does not exist anymore
+GONE_STATUS_CODES = (404, 410)
+
+
+def get_origin(endpoint: str) -> str:
+    url = urlparse(endpoint)
+    return f'{url.scheme}://{url.netloc}'
+
+
+class PushEngine:
+    """
+    Delivers web push messages concurrently.
+
+    Every push service origin gets its own pooled HTTP session, signed VAPID headers are cached
+    for their validity window, and subscriptions that the push service reports as gone are deleted.
+    The engine never touches the database from its worker threads.
+    """
+    def __init__(self, max_workers: int=8, timeout: float=10):
+        webpush_settings = getattr(settings, 'WEBPUSH_SETTINGS', {})
+        private_key = webpush_settings.get('VAPID_PRIVATE_KEY')
+        self._vapid = Vapid.from_string(private_key=private_key) if private_key else None
+        self._vapid_sub = f"mailto:{webpush_settings.get('VAPID_ADMIN_EMAIL')}"
+
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='push')
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        # origin -> (headers, expiration timestamp)
+        self._vapid_headers: Dict[str, Tuple[Dict[str, str], int]] = {}
+
+    def get_session(self, origin: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount(origin, adapter)
+                self._sessions[origin] = session
+            return session
+
+    def get_vapid_headers(self, origin: str) -> Dict[str, str]:
+        if self._vapid is None:
+            return {}
+        now = int(time.time())
+        with self._lock:
+            cached = self._vapid_headers.get(origin)
+            if cached is not None and cached[1] - VAPID_RENEW_MARGIN_SECS > now:
+                return cached[0]
+            exp = now + VAPID_VALIDITY_SECS
+            headers = self._vapid.sign({'sub': self._vapid_sub, 'aud': origin, 'exp': exp})
+            self._vapid_headers[origin] = (headers, exp)
+            return headers
+
+    def send(self, subscription: SubscriptionInfo, data: str, ttl: int) -> bool:
+        # Returns False if the subscription is gone, raises WebPushException on other errors
+        origin = get_origin(subscription.endpoint)
+        try:
+            webpush(
+                subscription_info={
+                    'endpoint': subscription.endpoint,
+                    'keys': {'p256dh': subscription.p256dh, 'auth': subscription.auth},
+                },
+                data=data,
+                ttl=ttl,
+                headers=dict(self.get_vapid_headers(origin)),
+                timeout=self.timeout,
+                requests_session=self.get_session(origin),
+            )
+        except WebPushException as e:
+            if e.response is not None and e.response.status_code in GONE_STATUS_CODES:
+                return False
+            raise
+        return True
+
+    def send_many(self, messages: Iterable[Tuple[int, dict, int, Collection[int]]]) -> Dict[int, Tuple[List[int], Optional[Exception]]]:
+        """
+        Sends every (user id, payload, ttl, skipped subscription ids) message to the user's other subscriptions.
+
+        Returns, indexed by position, the ids of the subscriptions each message is done with (delivered,
+        or gone) and its first error (None if no subscription failed), and deletes the subscriptions
+        that are gone.
+        """
+        messages = list(messages)
+        subscriptions: Dict[int, List[SubscriptionInfo]] = {}
+        infos = PushInformation.objects\
+            .filter(user_id__in={x[0] for x in messages})\
+            .select_related('subscription')
+        for info in infos:
+            subscriptions.setdefault(info.user_id, []).append(info.subscription)
+
+        futures = []
+        for i, (user_id, payload, ttl, skipped) in enumerate(messages):
+            data = json.dumps(payload)
+            for subscription in subscriptions.get(user_id, []):
+                if subscription.id not in skipped:
+                    futures.append((i, subscription, self._executor.submit(self.send, subscription, data, ttl)))
+
+        results: Dict[int, Tuple[List[int], Optional[Exception]]] = {i: ([], None) for i in range(len(messages))}
+        gone = []
+        for i, subscription, future in futures:
+            done, error = results[i]
+            try:
+                if not future.result():
+                    gone.append(subscription.id)
+                done.append(subscription.id)
+            except Exception as e:
+                if error is None:
+                    results[i] = (done, e)
+        if gone:
+            SubscriptionInfo.objects.filter(id__in=gone).delete()
+        return results
+
+
+_engine: Optional[PushEngine] = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> PushEngine:
+    # One engine per process, so that connections and VAPID headers are reused between batches
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = PushEngine()
+        return _engine
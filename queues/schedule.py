@@ -0,0 +1,79 @@
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+from django.core.cache import cache
+from django.utils import timezone
+
+
+OpenRange = Tuple[time, time]
+
+# Cached schedules are reloaded at least this often: an invalidation that raced with a reload
+# does not last, and the window of the cached exceptions moves forward
+SCHEDULE_CACHE_SECS = 24 * 60 * 60
+
+
+def schedule_cache_key(queue_id) -> str:
+    return f'queue-schedule-{queue_id}'
+
+
+class CompiledSchedule:
+    """
+    Weekly schedule and exceptions of a queue, resolved in memory.
+
+    It's built with two queries and kept in the cache until a range or an exception of the queue
+    changes (see queues.signals), so looking up a day does not hit the database. The cached
+    schedule only has the exceptions from yesterday on, older days (e.g. statistics) get a
+    schedule of their own, loaded from the first day they need.
+    """
+    def __init__(self, weekly: List[Optional[OpenRange]], exceptions: Dict[date, Optional[OpenRange]], since: Optional[date]=None):
+        # weekly[weekday] is the opening range of that day (or None if it's closed)
+        self.weekly = weekly
+        # exceptions[day] overrides the weekly range, None means closed
+        self.exceptions = exceptions
+        # First day with its exceptions loaded, None if all of them are
+        self.since = since
+
+    @classmethod
+    def load(cls, queue_id, since: Optional[date]=None) -> 'CompiledSchedule':
+        from .models import QueueOpenException, QueueOpenRange
+
+        weekly = [None] * 7
+        for x in QueueOpenRange.objects.filter(queue_id=queue_id):
+            weekly[x.day] = (x.from_time, x.to_time)
+        exceptions = QueueOpenException.objects.filter(queue_id=queue_id)
+        if since is not None:
+            exceptions = exceptions.filter(day__gte=since)
+        exceptions = {
+            x.day: (x.from_time, x.to_time) if x.from_time is not None else None
+            for x in exceptions
+        }
+        return cls(weekly, exceptions, since)
+
+    @classmethod
+    def get(cls, queue_id, since: Optional[date]=None) -> 'CompiledSchedule':
+        # Schedule valid from since on (default: from today in every timezone)
+        key = schedule_cache_key(queue_id)
+        schedule = cache.get(key)
+        if schedule is None:
+            # Yesterday in UTC is today or earlier in every timezone
+            schedule = cls.load(queue_id, timezone.now().date() - timedelta(days=1))
+            cache.set(key, schedule, SCHEDULE_CACHE_SECS)
+        if since is not None and not schedule.covers(since):
+            return cls.load(queue_id, since)
+        return schedule
+
+    def covers(self, day: date) -> bool:
+        return self.since is None or self.since <= day
+
+    @staticmethod
+    def invalidate(queue_id):
+        cache.delete(schedule_cache_key(queue_id))
+
+    def get_open_range(self, day: date) -> Optional[OpenRange]:
+        assert self.covers(day), "The exceptions of the day are not loaded"
+        if day in self.exceptions:
+            return self.exceptions[day]
+        return self.weekly[day.weekday()]
+
+    def is_open_at(self, dt: datetime) -> bool:
+        open_range = self.get_open_range(dt.date())
+        return open_range is not None and open_range[0] < dt.time() < open_range[1]
@@ -0,0 +1,60 @@
+import re
+from django.db import NotSupportedError, connection
+from django.db.models import F, Lookup, QuerySet
+from django.db.models.expressions import RawSQL
+
+# Results per page of the search page
+SEARCH_PAGE_SIZE = 20
+# Longer queries are cut, every word costs a lookup in the index
+SEARCH_MAX_WORDS = 8
+
+# Same split as the unicode61 tokenizer of the index (underscores separate words)
+WORD = re.compile(r'[^\W_]+')
+
+
+class Match(Lookup):
+    # FTS5 full-text match, the left side is the hidden column named after the table
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor != 'sqlite':
+            raise NotSupportedError("MATCH is only supported on SQLite")
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+def get_words(text: str) -> list:
+    return WORD.findall(text.lower())[:SEARCH_MAX_WORDS]
+
+
+def search_queues(queryset: QuerySet, text: str) -> QuerySet:
+    """
+    Queues of queryset whose name or description contain every word of text (as a prefix), best first.
+
+    The full-text index is queried first and joined to the queues, so the cost depends on the
+    number of matches instead of the number of queues. Filters of queryset (e.g. visible_to)
+    only apply to the matches.
+    """
+    words = get_words(text)
+    if not words:
+        return queryset.none()
+
+    if connection.vendor == 'postgresql':
+        # Prefix matches of every word, on the tsvector column added by migration 0020. Accents are
+        # removed on both sides, like SQLite's remove_diacritics (see migration 0023)
+        tsquery = "to_tsquery('simple', queues_unaccent(%s))"
+        terms = ' & '.join(f'{w}:*' for w in words)
+        matches = RawSQL(f'SELECT id FROM queues_queuesearchdocument WHERE document @@ {tsquery}', [terms])
+        rank = RawSQL(f'ts_rank("queues_queuesearchdocument"."document", {tsquery})', [terms])
+        return queryset\
+            .filter(search_document__id__in=matches)\
+            .annotate(search_rank=rank)\
+            .order_by('-search_rank', 'name')
+
+    # FTS5 query: every word quoted (no operators from the user) and used as a prefix
+    query = ' '.join(f'"{w}"*' for w in words)
+    # MATCH can't be used on the nullable side of a LEFT JOIN, isnull makes the joins INNER
+    return queryset\
+        .filter(Match(F('search_document__index__match'), query), search_document__index__isnull=False)\
+        .order_by('search_document__index__rank', 'name')
@@ -0,0 +1,38 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import QQueue, QueueOpenException, QueueOpenRange, QueueSearchDocument, Ticket
+from .schedule import CompiledSchedule
+
+
+@receiver(post_save, sender=QueueOpenRange)
+@receiver(post_delete, sender=QueueOpenRange)
+@receiver(post_save, sender=QueueOpenException)
+@receiver(post_delete, sender=QueueOpenException)
+def invalidate_schedule(sender, instance, **kwargs):
+    # Now for the rest of this transaction, and again once it commits: a concurrent request may
+    # have cached the schedule it read before the commit in the meantime
+    queue_id = instance.queue_id
+    CompiledSchedule.invalidate(queue_id)
+    transaction.on_commit(lambda: CompiledSchedule.invalidate(queue_id))
+
+
+@receiver(post_save, sender=QueueOpenRange)
+@receiver(post_delete, sender=QueueOpenRange)
+@receiver(post_save, sender=QueueOpenException)
+@receiver(post_delete, sender=QueueOpenException)
+@receiver(post_delete, sender=Ticket)
+def bump_queue_version(sender, instance, **kwargs):
+    # Saved tickets bump the version themselves (see Ticket._on_saved), also when they are closed without save
+    QQueue.bump_version(instance.queue_id)
+
+
+@receiver(post_save, sender=QQueue)
+def index_queue(sender, instance, created, update_fields=None, **kwargs):
+    # The search index follows the document (see queues.search), deleted queues take it along (CASCADE)
+    if update_fields is not None and not {'name', 'description'} & set(update_fields):
+        return
+    fields = {'name': instance.name, 'description': instance.description}
+    if created or not QueueSearchDocument.objects.filter(queue=instance).update(**fields):
+        QueueSearchDocument.objects.create(queue=instance, **fields)
@@ -0,0 +1,76 @@
+import math
+from typing import Dict, Iterable, Optional
+
+
+class WaitSketch:
+    """
+    Mergeable quantile sketch for wait times (DDSketch).
+
+    Values are counted in logarithmic bins, so any quantile is estimated within
+    RELATIVE_ACCURACY of the real value while only storing a few dozen bins, and two
+    sketches (e.g. two days) can be merged by summing their bins.
+    """
+    RELATIVE_ACCURACY = 0.02
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self, bins: Optional[Dict[int, int]]=None, zeros: int=0):
+        # bins[i] counts the values in (GAMMA^(i-1), GAMMA^i]
+        self.bins = bins if bins is not None else {}
+        # Values <= 0 (tickets served on time) don't have a logarithm
+        self.zeros = zeros
+
+    @classmethod
+    def of(cls, values: Iterable[float]) -> 'WaitSketch':
+        sketch = cls()
+        for x in values:
+            sketch.add(x)
+        return sketch
+
+    @classmethod
+    def from_json(cls, data: Optional[dict]) -> 'WaitSketch':
+        if not data:
+            return cls()
+        return cls({int(i): c for i, c in data.get('b', [])}, data.get('z', 0))
+
+    def to_json(self) -> dict:
+        return {
+            'z': self.zeros,
+            'b': sorted([i, c] for i, c in self.bins.items()),
+        }
+
+    @property
+    def count(self) -> int:
+        return self.zeros + sum(self.bins.values())
+
+    def add(self, value: float, count: int=1):
+        # A negative count removes values that were previously added
+        if value <= 0:
+            self.zeros += count
+            return
+        i = math.ceil(math.log(value) / self.LOG_GAMMA)
+        c = self.bins.get(i, 0) + count
+        if c > 0:
+            self.bins[i] = c
+        else:
+            self.bins.pop(i, None)
+
+    def merge(self, other: 'WaitSketch'):
+        self.zeros += other.zeros
+        for i, c in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + c
+
+    def quantile(self, q: float) -> Optional[float]:
+        count = self.count
+        if count <= 0:
+            return None
+        rank = q * (count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                # Middle of the bin, within RELATIVE_ACCURACY of every value in it
+                return 2 * self.GAMMA ** i / (self.GAMMA + 1)
+        return 2 * self.GAMMA ** max(self.bins) / (self.GAMMA + 1)
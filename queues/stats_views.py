@@ -1,18 +1,146 @@
 
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Tuple
 from uuid import uuid4
-from django.db import connection
-from django.http import Http404, HttpRequest, JsonResponse
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, ExtractHour, ExtractIsoWeekDay, TruncHour
+from django.http import Http404, HttpRequest, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import render, get_object_or_404
-from .models import QQueue, QueueUserRole
+from core.utils import conditional_response, make_etag
+from .models import QQueue, QueueUserRole, TicketState
+from .schedule import CompiledSchedule
+from .sketch import WaitSketch
 
 
-def queue_stats(request: HttpRequest, pk: uuid4):
+# Supported time scales, from the finest to the coarsest
+TIME_SCALES = ['hours', 'days', 'weeks', 'months']
+# Rough length of a bucket of each time scale, in days
+TIME_SCALE_DAYS = {'hours': 1 / 24, 'days': 1, 'weeks': 7, 'months': 30}
+# The time scale is made coarser until the chart has at most this many points
+MAX_POINTS = 400
+# Wait time percentiles reported alongside the average
+PERCENTILES = (0.5, 0.9, 0.99)
+# Number of weeks aggregated in the hour-of-week heatmap
+HEATMAP_DEFAULT_WEEKS = 12
+HEATMAP_MAX_WEEKS = 104
+
+
+def pick_time_scale(requested: str, start: date, end: date) -> str:
+    days = (end - start).days + 1
+    for scale in TIME_SCALES[TIME_SCALES.index(requested):]:
+        if days / TIME_SCALE_DAYS[scale] <= MAX_POINTS:
+            return scale
+    return TIME_SCALES[-1]
+
+
+def bucket_of(x: datetime, scale: str) -> datetime:
+    # Start of the bucket that contains x (naive, in the queue's timezone)
+    if scale == 'hours':
+        return x.replace(minute=0, second=0, microsecond=0)
+    x = x.replace(hour=0, minute=0, second=0, microsecond=0)
+    if scale == 'weeks':
+        return x - timedelta(days=x.weekday())
+    if scale == 'months':
+        return x.replace(day=1)
+    return x
+
+
+def next_bucket(x: datetime, scale: str) -> datetime:
+    if scale == 'hours':
+        return x + timedelta(hours=1)
+    if scale == 'days':
+        return x + timedelta(days=1)
+    if scale == 'weeks':
+        return x + timedelta(days=7)
+    return (x + timedelta(days=32)).replace(day=1)
+
+
+def collect_buckets(queue: QQueue, start: date, end: date, scale: str) -> Dict[datetime, Tuple[List[int], WaitSketch]]:
+    # bucket -> ([served, canceledQueue, canceledUser, open, expired, wait_sum, wait_count], wait sketch)
+    res = defaultdict(lambda: ([0] * 7, WaitSketch()))
+    if scale == 'hours':
+        # Hours are not in the rollup, but hourly charts only cover a few days
+        served = Q(state=TicketState.SERVED)
+        tickets = queue.tickets_set.filter(
+            requested_time__gte=datetime.combine(start, time.min, queue.tz),
+            requested_time__lt=datetime.combine(end + timedelta(days=1), time.min, queue.tz),
+        )
+        rows = tickets\
+            .annotate(x=TruncHour('requested_time', tzinfo=queue.tz))\
+            .values('x')\
+            .annotate(
+                served=Count('id', filter=served),
+                canceled_queue=Count('id', filter=Q(state=TicketState.QUEUE_CANCELLED)),
+                canceled_user=Count('id', filter=Q(state=TicketState.USER_CANCELLED)),
+                open=Count('id', filter=Q(state=TicketState.OPEN)),
+                expired=Count('id', filter=Q(state=TicketState.EXPIRED)),
+                wait_sum=Coalesce(Sum('wait_time_secs', filter=served), 0),
+                wait_count=Count('wait_time_secs', filter=served),
+            )\
+            .order_by('x')
+        rows = [
+            (x['x'].astimezone(queue.tz).replace(tzinfo=None), x['served'], x['canceled_queue'], x['canceled_user'], x['open'], x['expired'], x['wait_sum'], x['wait_count'])
+            for x in rows
+        ]
+        waits = tickets.filter(served, wait_time_secs__isnull=False).values_list('requested_time', 'wait_time_secs')
+        for requested_time, wait_time_secs in waits:
+            res[bucket_of(requested_time.astimezone(queue.tz).replace(tzinfo=None), scale)][1].add(wait_time_secs)
+    else:
+        rows = queue.daily_stats.filter(day__range=(start, end)).order_by('day').values_list(
+            'day', 'served', 'canceled_queue', 'canceled_user', 'open', 'expired', 'wait_sum', 'wait_count', 'wait_sketch'
+        )
+        rows = [(datetime.combine(x[0], time.min),) + x[1:] for x in rows]
+        # Percentiles of the bucket are computed by merging the daily sketches
+        for row in rows:
+            res[bucket_of(row[0], scale)][1].merge(WaitSketch.from_json(row[8]))
+
+    for row in rows:
+        bucket = res[bucket_of(row[0], scale)][0]
+        for i, x in enumerate(row[1:8]):
+            bucket[i] += x
+    return res
+
+
+def closed_regions(schedule: CompiledSchedule, start: date, end: date, shift: timedelta=timedelta(hours=12)) -> List[dict]:
+    # Runs of closed days between start and end (inclusive), in a single pass over the schedule.
+    # Daily charts shift regions by half a day to line up with the step chart
+    regionfmt = '%Y-%m-%dT%H:%M'
+    regions = []
+    last_start = None
+
+    def push_end(day: date):
+        regions.append({
+            'start': (datetime.combine(last_start, time.min) - shift).strftime(regionfmt),
+            'end': (datetime.combine(day, time.min) - shift).strftime(regionfmt),
+        })
+
+    for i in range(0, (end - start).days + 2):
+        day = start + timedelta(days=i)
+        is_closed = schedule.get_open_range(day) is None
+        if is_closed and last_start is None: # Open
+            last_start = day
+        elif not is_closed and last_start is not None: # Close
+            push_end(day)
+            last_start = None
+
+    if last_start is not None:
+        push_end(day)
+    return regions
+
+
+def get_stats_queue(request: HttpRequest, pk: uuid4) -> QQueue:
     queue = get_object_or_404(QQueue, id=pk)
 
     user_role = queue.get_user_role(request.user)
     if not request.user.has_perm('queues.view_all_stats') and  user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
         raise Http404()
+    return queue
+
+
+def queue_stats(request: HttpRequest, pk: uuid4):
+    queue = get_stats_queue(request, pk)
 
     return render(request, 'queues/stats.html', context={
         'queue': queue,
@@ -20,100 +148,135 @@ def queue_stats(request: HttpRequest, pk: uuid4):
 
 
 def api_query(request: HttpRequest, pk: uuid4):
-    queue = get_object_or_404(QQueue, id=pk)
+    queue = get_stats_queue(request, pk)
 
-    user_role = queue.get_user_role(request.user)
-    if not request.user.has_perm('queues.view_all_stats') and  user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
-        raise Http404()
+    # Statistics only change when the queue does
+    etag = make_etag(queue.id, queue.version, sorted(request.GET.items()))
+    return conditional_response(request, etag, queue.version_time, lambda: compute_stats(request, queue), private=True)
 
-    # Input: { from, to }
-    # { nameFormat, tickets: { x, ticket, canceledQueue, canceledUser }, waits: { x, avgWait } }
+
+def compute_stats(request: HttpRequest, queue: QQueue):
+
+    # Input: { from, to, timeScale }
+    # { nameFormat, timeScale, tickets: { x, served, canceledQueue, canceledUser, open, expired }, waits: { x, avgWait, p50Wait, p90Wait, p99Wait }, waitPercentiles }
     datefmt = '%Y-%m-%d'
 
-    start = datetime.strptime(request.GET.get('from'), datefmt)
-    end = datetime.strptime(request.GET.get('to'), datefmt)
-
-    query = f'''
-SELECT date(requested_time) as name,
-count(CASE WHEN state = "SER" THEN 1 END) as served,
-count(CASE WHEN state = "QCA" THEN 1 END) as canceledQueue,
-count(CASE WHEN state = "UCA" THEN 1 END) as canceledUser,
-count(CASE WHEN state = "OPE" THEN 1 END) as open,
--- Non-served tickets have NULL wait_time_secs
-avg(wait_time_secs) as avgWait
-FROM queues_ticket
-WHERE queue_id = %s AND date(requested_time) BETWEEN %s AND %s
-GROUP BY name
-'''
-    args = (
-        pk.hex,
-        start.strftime(datefmt),
-        end.strftime(datefmt)
-    )
+    try:
+        start = datetime.strptime(request.GET.get('from'), datefmt).date()
+        end = datetime.strptime(request.GET.get('to'), datefmt).date()
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest()
+    requested_scale = request.GET.get('timeScale', 'days')
+    if requested_scale not in TIME_SCALES or end < start:
+        return HttpResponseBadRequest()
+    scale = pick_time_scale(requested_scale, start, end)
+    namefmt = '%Y-%m-%d %H:%M' if scale == 'hours' else datefmt
+
     AGGREG_NAMES = {
-        'tickets': ('served', 'canceledQueue', 'canceledUser', 'open'),
-        'waits': ('avgWait',)
+        'tickets': ('served', 'canceledQueue', 'canceledUser', 'open', 'expired'),
+        'waits': ('avgWait', 'p50Wait', 'p90Wait', 'p99Wait'),
     }
     data = {
-        'nameFormat': datefmt,
+        'nameFormat': namefmt,
+        'timeScale': scale,
     }
     data.update(
         {aggName: [[name] for name in (('x',) + names)] for aggName, names in AGGREG_NAMES.items()}
     )
-    with connection.cursor() as cursor:
-        cursor.execute(query, args)
-        res = cursor.fetchall()
-        old_date = -1
 
-        def fill_gaps_until(idate):
-            nonlocal old_date
-            for i in range(old_date + 1, idate):
-                datestr = (start + timedelta(days=i)).strftime(datefmt)
+    res = collect_buckets(queue, start, end, scale)
+    total_waits = WaitSketch()
+    # Every bucket is emitted, the ones without tickets are filled with zeros
+    bucket = bucket_of(datetime.combine(start, time.min), scale)
+    last = datetime.combine(end, time.max)
+    while bucket <= last:
+        counts, waits = res.get(bucket, ([0] * 7, WaitSketch()))
+        served, canceled_queue, canceled_user, open, expired, wait_sum, wait_count = counts
+        total_waits.merge(waits)
+        values = {
+            'tickets': (served, canceled_queue, canceled_user, open, expired),
+            'waits': (wait_sum / wait_count if wait_count > 0 else 0,) + tuple(waits.quantile(q) or 0 for q in PERCENTILES),
+        }
+        name = bucket.strftime(namefmt)
+        for aggName in AGGREG_NAMES:
+            data[aggName][0].append(name)
+            for i, x in enumerate(values[aggName]):
+                data[aggName][i + 1].append(x)
+        bucket = next_bucket(bucket, scale)
 
-                for aggName, names in AGGREG_NAMES.items():
-                    data[aggName][0].append(datestr)
-                    for i in range(0, len(names)):
-                        data[aggName][i + 1].append(0)
+    data['waitPercentiles'] = {f'p{round(q * 100)}': total_waits.quantile(q) for q in PERCENTILES}
 
-            old_date = idate
+    if scale == 'days':
+        data['regions'] = closed_regions(queue.get_schedule(start), start, end)
+    elif scale == 'hours':
+        data['regions'] = closed_regions(queue.get_schedule(start), start, end, timedelta(0))
+    else:
+        # Coarser buckets cover days out of the range: regions span the charted buckets, clipped
+        # to their first and last edges
+        first = bucket_of(datetime.combine(start, time.min), scale).date()
+        last = next_bucket(bucket_of(datetime.combine(end, time.min), scale), scale).date() - timedelta(days=1)
+        data['regions'] = closed_regions(queue.get_schedule(first), first, last, timedelta(0))
 
+    return JsonResponse(data)
 
-        for row in res:
-            idate = (datetime.strptime(row[0], datefmt) - start).days
-            # Fill gaps
-            fill_gaps_until(idate)
 
-            i = 1
-            for aggName, keys in AGGREG_NAMES.items():
-                data[aggName][0].append(row[0])
-                for ikey in range(len(keys)):
-                    data[aggName][ikey + 1].append(row[i] if row[i] is not None else 0)
-                    i += 1
-        fill_gaps_until((end - start).days + 1)
+def compute_heatmap(queue: QQueue, start: datetime, end: datetime) -> dict:
+    # 7x24 (monday first) matrices of the tickets requested between start and end, in the queue's timezone
+    served = Q(state=TicketState.SERVED)
+    rows = queue.tickets_set\
+        .filter(requested_time__gte=start, requested_time__lt=end)\
+        .annotate(
+            weekday=ExtractIsoWeekDay('requested_time', tzinfo=queue.tz),
+            hour=ExtractHour('requested_time', tzinfo=queue.tz),
+        )\
+        .values('weekday', 'hour')\
+        .annotate(
+            count=Count('id'),
+            served=Count('id', filter=served),
+            wait_sum=Coalesce(Sum('wait_time_secs', filter=served), 0),
+            wait_count=Count('wait_time_secs', filter=served),
+        )\
+        .order_by()
 
-    regions = []
-    last_start = None
-    def push_end():
-        nonlocal last_start
-        regions.append({
-            'start': (last_start - timedelta(days=1)).date().strftime(datefmt)  + 'T12:00',
-            'end': (day - timedelta(days=1)).date().strftime(datefmt) + 'T12:00',
-        })
+    counts = [[0] * 24 for _ in range(7)]
+    served_ratio = [[0] * 24 for _ in range(7)]
+    mean_wait = [[0] * 24 for _ in range(7)]
+    for row in rows:
+        day, hour = row['weekday'] - 1, row['hour']
+        counts[day][hour] = row['count']
+        served_ratio[day][hour] = row['served'] / row['count']
+        mean_wait[day][hour] = row['wait_sum'] / row['wait_count'] if row['wait_count'] > 0 else 0
+    return {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'counts': counts,
+        'servedRatio': served_ratio,
+        'meanWait': mean_wait,
+    }
 
-        last_start = None
 
-    for i in range(0, (end - start).days + 2):
-        day = (start + timedelta(days=i))
-        is_closed = queue.get_open_range(day) is None
-        if is_closed and last_start is None: # Open
-            last_start = day
-        elif not is_closed and  last_start is not None: # Close
-            push_end()
+def api_heatmap(request: HttpRequest, pk: uuid4):
+    queue = get_stats_queue(request, pk)
 
-    if last_start is not None:
-        push_end()
+    # Input: { weeks }
+    # Only complete weeks are used, so the result can be cached until the current week ends
+    try:
+        weeks = int(request.GET.get('weeks', HEATMAP_DEFAULT_WEEKS))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not (1 <= weeks <= HEATMAP_MAX_WEEKS):
+        return HttpResponseBadRequest()
 
-    data['regions'] = regions
+    now = datetime.now(queue.tz)
+    week_start = now.date() - timedelta(days=now.weekday())
+    end = datetime.combine(week_start, time.min, queue.tz)
+    start = datetime.combine(week_start - timedelta(weeks=weeks), time.min, queue.tz)
 
+    key = f'queue-heatmap-{queue.id}-{weeks}-{week_start.isoformat()}'
+    data = cache.get(key)
+    if data is None:
+        data = compute_heatmap(queue, start, end)
+        next_week = datetime.combine(week_start + timedelta(weeks=1), time.min, queue.tz)
+        cache.set(key, data, max(1, int((next_week - now).total_seconds())))
 
     return JsonResponse(data)
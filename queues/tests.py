@@ -1,10 +1,35 @@
-from datetime import time, datetime
+from datetime import time, datetime, timedelta
+from importlib import import_module
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import base64
+import os
+from threading import Thread, Timer
+from unittest import skipUnless
+from urllib.parse import parse_qs, urlparse
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.apps import apps
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from django.utils.http import http_date
 
-from queues.models import JoinMode, QQueue, QueueOpenRange, QueueUser, QueueUserRole, Ticket, TicketState
+from queues import board, events
+from queues.positions import get_line, get_position
+from queues.search import SEARCH_PAGE_SIZE, search_queues
+from queues.schedule import schedule_cache_key
+from queues.sketch import WaitSketch
+from queues.notifications import MAX_ATTEMPTS, deliver_due, remind_due
+from queues.push import PushEngine
+from queues.models import JoinMode, Notification, NotificationKind, NotificationState, QQueue, QueueDailyStats, QueueOpenException, QueueOpenRange, QueueUser, QueueUserRole, Ticket, TicketSlot, TicketState, TicketStateError, WorkerLease
 from users.models import User
+from webpush.models import PushInformation, SubscriptionInfo
 
 
 class QueueTests(TestCase):
@@ -60,6 +85,37 @@ class QueueTests(TestCase):
         uinvited.friends.add(uadmin)
         self.assertTrue(queue1.is_visible_by(uinvited))
 
+    def test_visibility_queryset(self):
+        from django.contrib.auth.models import AnonymousUser
+
+        users = [User.objects.create_user(username=f'test_visibility_queryset{i}', password='12345') for i in range(5)]
+        owner, employee, invited, friend, stranger = users
+        admin = User.objects.create_superuser(username='test_visibility_queryset_admin', password='12345')
+        friend.friends.add(owner)
+        owner.friends.add(friend)
+        invited.friends.add(owner)
+        for mode in JoinMode.values:
+            for hidden in (False, True):
+                queue = QQueue.objects.create(name=f"test_visibility_queryset_{mode}", join_mode=mode, is_privacy_hidden=hidden)
+                QueueUser(queue=queue, user=owner, role=QueueUserRole.OWNER).save()
+                QueueUser(queue=queue, user=employee, role=QueueUserRole.EMPLOYEE).save()
+                QueueUser(queue=queue, user=invited, role=QueueUserRole.INVITED).save()
+        # Friends with an invited user only
+        lonely = QQueue.objects.create(name="test_visibility_queryset_lonely", join_mode=JoinMode.FRIENDS_ONLY)
+        QueueUser(queue=lonely, user=invited, role=QueueUserRole.INVITED).save()
+
+        queues = list(QQueue.objects.all())
+        for user in users + [admin, AnonymousUser()]:
+            expected = {q for q in queues if q.is_visible_by(user)}
+            # A single query, whatever the number of queues (the permissions are cached by now)
+            with self.assertNumQueries(1):
+                self.assertEqual(set(QQueue.objects.visible_to(user)), expected, user)
+            self.assertEqual(set(QQueue.objects.bookable_by(user)), {q for q in queues if q.can_user_book(user)}, user)
+
+        self.client.force_login(friend)
+        res = self.client.get(reverse('queues:search'), {'q': 'test_visibility_queryset'})
+        self.assertEqual(set(res.context['result']), {q for q in queues if q.join_mode != JoinMode.URL_ONLY and q.is_visible_by(friend)})
+        self.assertEqual(self.client.get(reverse('home')).status_code, 200)
 
     def test_queue_fixed_time_booking(self):
         u = User.objects.create_user(username='test_queue_fixed_time_booking', password='12345')
@@ -167,3 +223,935 @@ class QueueTests(TestCase):
                 user=u,
                 requested_time=datetime.combine(day, time(9, 30), q.tz)
             ).save()
+
+    def test_ticket_slots(self):
+        u = User.objects.create_user(username='test_ticket_slots', password='12345')
+        q = QQueue(name="test_ticket_slots1", fixed_ticket_time_minutes=30)
+        q.save()
+        day = datetime(2022, 1, 3, tzinfo=q.tz).date()
+        QueueOpenRange(queue=q, day=day.weekday(), from_time=time(9), to_time=time(10)).save()
+
+        t1 = Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9), q.tz))
+        t1.save()
+        t2 = Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9, 30), q.tz))
+        t2.save()
+        self.assertEqual(q.slots_set.filter(day=day).count(), 2)
+
+        # Closed tickets free their slot
+        t1.serve(now=datetime.combine(day, time(9, 5), q.tz))
+        t2.cancel('queue', "closed")
+        self.assertEqual(q.slots_set.count(), 0)
+
+    def test_book_range_api(self):
+        u = User.objects.create_user(username='test_book_range_api', password='12345')
+        q = QQueue(name="test_book_range_api1", join_mode=JoinMode.PUBLIC, fixed_ticket_time_minutes=30)
+        q.save()
+        day = timezone.localdate() + timedelta(days=7)
+        QueueOpenRange(queue=q, day=day.weekday(), from_time=time(9), to_time=time(10)).save()
+        Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9), q.tz)).save()
+        Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9, 30), q.tz)).save()
+        self.client.force_login(u)
+
+        url = reverse('queues:queue_book_api', args=[q.id])
+        res = self.client.get(url, data={'from': day.isoformat(), 'to': (day + timedelta(days=7)).isoformat()})
+        self.assertEqual(res.status_code, 200)
+        days = res.json()['days']
+        self.assertEqual(len(days), 8)
+        self.assertEqual(days[day.isoformat()], {'state': 'full'})
+        self.assertEqual(days[(day + timedelta(days=1)).isoformat()], {'state': 'closed'})
+        self.assertEqual(days[(day + timedelta(days=7)).isoformat()]['state'], 'choose')
+
+        # Revalidated with the ETag only: the answer also depends on the clock
+        self.assertEqual(res['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Last-Modified', res)
+        data = {'from': day.isoformat(), 'to': (day + timedelta(days=7)).isoformat()}
+        self.assertEqual(self.client.get(url, data=data, HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, data=data, HTTP_IF_MODIFIED_SINCE=http_date()).status_code, 200)
+        Ticket(queue=q, user=u, requested_time=datetime.combine(day + timedelta(days=7), time(9), q.tz)).save()
+        res = self.client.get(url, data=data, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['days'][(day + timedelta(days=7)).isoformat()]['state'], 'choose')
+
+        # Ranges are capped
+        res = self.client.get(url, data={'from': day.isoformat(), 'to': (day + timedelta(days=200)).isoformat()})
+        self.assertEqual(res.status_code, 400)
+
+    def test_compiled_schedule(self):
+        q = QQueue(name="test_compiled_schedule1")
+        q.save()
+        day = timezone.now().astimezone(q.tz).date() + timedelta(days=7)
+        r = QueueOpenRange(queue=q, day=day.weekday(), from_time=time(9), to_time=time(10))
+        r.save()
+
+        self.assertEqual(q.get_open_range(day), (time(9), time(10)))
+        # Once compiled, the schedule is served from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(q.get_open_range(day), (time(9), time(10)))
+            self.assertTrue(q.is_open_at(datetime.combine(day, time(9, 30))))
+
+        # Changes to ranges and exceptions invalidate it
+        r.to_time = time(11)
+        r.save()
+        self.assertEqual(q.get_open_range(day), (time(9), time(11)))
+        exc = QueueOpenException(queue=q, day=day)
+        exc.save()
+        self.assertIsNone(q.get_open_range(day))
+        exc.delete()
+        self.assertEqual(q.get_open_range(day), (time(9), time(11)))
+
+        # Invalidated again once the transaction commits: a request that read the schedule
+        # before the commit may have cached it in the meantime
+        stale = q.get_schedule()
+        with self.captureOnCommitCallbacks() as callbacks:
+            r.to_time = time(12)
+            r.save()
+        cache.set(schedule_cache_key(q.id), stale)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(q.get_open_range(day), (time(9), time(12)))
+
+        # Only the exceptions from today on are cached, older days load their own
+        past = day - timedelta(days=28)
+        QueueOpenException(queue=q, day=past).save()
+        self.assertNotIn(past, q.get_schedule().exceptions)
+        self.assertIsNone(q.get_open_range(past))
+        with self.assertNumQueries(0):
+            q.get_open_range(day)
+
+    def test_call_next(self):
+        owner = User.objects.create_user(username='test_call_next_owner', password='12345')
+        u = User.objects.create_user(username='test_call_next', password='12345')
+        q = QQueue(name="test_call_next1")
+        q.save()
+        QueueUser(queue=q, user=owner, role=QueueUserRole.OWNER).save()
+        now = datetime.now(q.tz).replace(hour=12, minute=0)
+        tickets = [Ticket(queue=q, user=u, requested_time=now - timedelta(minutes=10 * i)) for i in range(3)]
+        for t in tickets:
+            t.save()
+
+        # Two desks holding the same ticket, only the first one serves it
+        stale = Ticket.objects.get(id=tickets[2].id)
+        version = QQueue.objects.get(id=q.id).version
+        self.assertEqual(q.call_next(now=now), tickets[2])
+        # The queue and stats rows shared by the desks are written in the same transaction
+        self.assertTrue(QueueDailyStats.objects.filter(queue=q, served=1).exists())
+        self.assertEqual(QQueue.objects.get(id=q.id).version, version + 1)
+        with self.assertRaises(TicketStateError):
+            stale.serve(now=now)
+        self.assertEqual(QueueDailyStats.objects.get(queue=q).served, 1)
+
+        # Stale queue instances don't lose each other's statistics
+        QQueue.objects.get(id=q.id).on_wait_time(60)
+        QQueue.objects.get(id=q.id).on_wait_time(60)
+        q.save()
+        q.refresh_from_db()
+        self.assertEqual(q.ticket_stats_count, 3)
+
+        self.client.force_login(owner)
+        url = reverse('queues:queue_manage_call_next', args=[q.id])
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.client.post(url)
+        self.client.post(url)
+        self.client.post(url)
+        self.assertEqual(q.get_open_tickets(now.date()).count(), 0)
+        self.assertEqual(QueueDailyStats.objects.get(queue=q).served, 3)
+
+    def test_transition_queries(self):
+        u = User.objects.create_user(username='test_transition_queries', password='12345')
+        q = QQueue(name="test_transition_queries1", fixed_ticket_time_minutes=30)
+        q.save()
+        # Today, so that the head of the line gets notified
+        day = datetime.now(q.tz).date()
+        QueueOpenRange(queue=q, day=day.weekday(), from_time=time(9), to_time=time(12)).save()
+        Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9), q.tz)).save()
+        q.get_schedule()
+
+        # Insert, slot, daily stats and version (plus the collision check)
+        t = Ticket(queue=q, user=u, requested_time=datetime.combine(day, time(9, 30), q.tz))
+        with self.assertNumQueries(7):
+            t.save()
+        # Ticket, slot and version (the stats of the day don't change), plus the collision check
+        with self.assertNumQueries(8):
+            t.reschedule(datetime.combine(day, time(10, 30), q.tz))
+        self.assertEqual(TicketSlot.objects.get(ticket=t).start, datetime.combine(day, time(10, 30), q.tz))
+        with self.assertRaises(ValidationError):
+            t.reschedule(datetime.combine(day, time(9), q.tz))
+
+        # Closure, slot, daily stats (and sketch), queue statistics with the version, head of the line, notification
+        t = Ticket.objects.select_related('queue').get(id=t.id)
+        with self.assertNumQueries(9):
+            t.serve(now=datetime.combine(day, time(10, 40), q.tz))
+        # Closure, slot, daily stats, version, head of the line (nobody is left)
+        t = Ticket.objects.select_related('queue').filter(state=TicketState.OPEN).get()
+        with self.assertNumQueries(7):
+            t.cancel('user', "bye")
+
+        stats = QueueDailyStats.objects.get(queue=q, day=day)
+        self.assertEqual((stats.open, stats.served, stats.canceled_user), (0, 1, 1))
+        self.assertEqual(stats.get_wait_sketch().count, 1)
+
+    def test_close_day(self):
+        owner = User.objects.create_user(username='test_close_day_owner', password='12345')
+        u = User.objects.create_user(username='test_close_day', password='12345')
+        q = QQueue(name="test_close_day1", fixed_ticket_time_minutes=5)
+        q.save()
+        QueueUser(queue=q, user=owner, role=QueueUserRole.OWNER).save()
+        day = datetime.now(q.tz).date()
+        QueueOpenRange(queue=q, day=day.weekday(), from_time=time(0), to_time=time(23, 55)).save()
+        start = datetime.combine(day, time(10), q.tz)
+        for i in range(60):
+            Ticket(queue=q, user=u, requested_time=start + timedelta(minutes=5 * i)).save()
+
+        # Tickets from 12:00 on, the same handful of queries for any number of tickets
+        with self.assertNumQueries(8):
+            self.assertEqual(q.close_day(day, "Closing early", keep=(time(0), time(12))), 36)
+        self.assertEqual(q.get_open_tickets(day).count(), 24)
+        self.assertEqual(q.slots_set.count(), 24)
+        self.assertEqual(Notification.objects.filter(kind=NotificationKind.CANCELLED).count(), 36)
+        stats = QueueDailyStats.objects.get(queue=q, day=day)
+        self.assertEqual((stats.open, stats.canceled_queue), (24, 36))
+
+        # Opening later as well: the tickets before the new opening time go too
+        self.assertEqual(q.close_day(day, "Opening late", keep=(time(11), time(11, 30))), 18)
+        self.assertEqual([t.requested_time.astimezone(q.tz).time() for t in q.get_open_tickets(day)], [time(11, 5 * i) for i in range(6)])
+        self.assertEqual(q.slots_set.count(), 6)
+
+        # From the exception form, closing at 10:00
+        self.client.force_login(owner)
+        self.client.post(reverse('queues:queue_add_exception', args=[q.id]), data={
+            'from_time': '00:00',
+            'to_time': '10:00',
+            'cancel_tickets': 'on',
+            'message': "Closed today",
+        })
+        self.assertEqual(q.get_open_tickets(day).count(), 0)
+        self.assertEqual(q.tickets_set.filter(cancel_message="Closed today").count(), 6)
+        stats.refresh_from_db()
+        self.assertEqual((stats.open, stats.canceled_queue), (0, 60))
+        QueueDailyStats.rebuild(q)
+        self.assertEqual(QueueDailyStats.objects.get(queue=q, day=day).canceled_queue, 60)
+
+
+class StatsTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='test_stats_owner', password='12345')
+        self.queue = QQueue(name="test_stats1")
+        self.queue.save()
+        QueueUser(queue=self.queue, user=self.owner, role=QueueUserRole.OWNER).save()
+        for day in range(5):
+            QueueOpenRange(queue=self.queue, day=day, from_time=time(9), to_time=time(18)).save()
+        QueueOpenException(queue=self.queue, day=datetime(2022, 1, 5).date()).save()
+        self.client.force_login(self.owner)
+
+    def query_stats(self, start: str, end: str, time_scale: str = 'days'):
+        return self.client.get(reverse('queues:queue_stats_api', args=[self.queue.id]), data={
+            'timeScale': time_scale,
+            'from': start,
+            'to': end,
+        })
+
+    def test_closed_regions(self):
+        res = self.query_stats('2022-01-03', '2022-01-10')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Cache-Control'], 'private, no-cache')
+        self.assertEqual(res.json()['regions'], [
+            {'start': '2022-01-04T12:00', 'end': '2022-01-05T12:00'},
+            {'start': '2022-01-07T12:00', 'end': '2022-01-09T12:00'},
+        ])
+
+    def test_closed_regions_weeks(self):
+        # The closed days of the first and last weeks are kept, even past the requested range
+        res = self.query_stats('2022-01-05', '2022-01-12', 'weeks')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['regions'], [
+            {'start': '2022-01-05T00:00', 'end': '2022-01-06T00:00'},
+            {'start': '2022-01-08T00:00', 'end': '2022-01-10T00:00'},
+            {'start': '2022-01-15T00:00', 'end': '2022-01-17T00:00'},
+        ])
+
+    def test_closed_regions_query_count(self):
+        counts = []
+        for end in ['2022-01-10', '2023-01-01', '2024-12-31']:
+            cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.query_stats('2022-01-01', end).status_code, 200)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_daily_stats(self):
+        u = User.objects.create_user(username='test_daily_stats', password='12345')
+        day = datetime(2022, 1, 3).date()
+        def book(h: int) -> Ticket:
+            t = Ticket(queue=self.queue, user=u, requested_time=datetime.combine(day, time(h), self.queue.tz))
+            t.save()
+            return t
+
+        book(9).serve(now=datetime.combine(day, time(9, 10), self.queue.tz))
+        book(10).serve(now=datetime.combine(day, time(10, 20), self.queue.tz))
+        book(11).cancel('user', "nope")
+        book(12).cancel('queue', "nope")
+        book(13)
+
+        expected = {'served': 2, 'canceled_queue': 1, 'canceled_user': 1, 'open': 1, 'wait_sum': 30 * 60, 'wait_count': 2}
+        self.assertEqual(self.queue.daily_stats.filter(day=day).values(*expected.keys()).get(), expected)
+        # Rebuilding from the tickets gives the same result, and new ETags
+        res = self.query_stats('2022-01-02', '2022-01-04')
+        QueueDailyStats.rebuild(self.queue)
+        self.assertEqual(self.queue.daily_stats.filter(day=day).values(*expected.keys()).get(), expected)
+        self.assertEqual(self.client.get(reverse('queues:queue_stats_api', args=[self.queue.id]), HTTP_IF_NONE_MATCH=res['ETag'], data={
+            'timeScale': 'days', 'from': '2022-01-02', 'to': '2022-01-04',
+        }).status_code, 200)
+
+        # So does the migration that fills the rollups of the existing tickets
+        self.queue.daily_stats.all().delete()
+        import_module('queues.migrations.0024_fill_daily_stats').fill_daily_stats(apps, None)
+        self.assertEqual(self.queue.daily_stats.filter(day=day).values(*expected.keys()).get(), expected)
+
+        data = self.query_stats('2022-01-02', '2022-01-04').json()
+        self.assertEqual(data['tickets'], [
+            ['x', '2022-01-02', '2022-01-03', '2022-01-04'],
+            ['served', 0, 2, 0],
+            ['canceledQueue', 0, 1, 0],
+            ['canceledUser', 0, 1, 0],
+            ['open', 0, 1, 0],
+            ['expired', 0, 0, 0],
+        ])
+        self.assertEqual(data['waits'][:2], [['x', '2022-01-02', '2022-01-03', '2022-01-04'], ['avgWait', 0, 15 * 60, 0]])
+        self.assertEqual([x[0] for x in data['waits'][2:]], ['p50Wait', 'p90Wait', 'p99Wait'])
+        self.assertAlmostEqual(data['waitPercentiles']['p50'], 10 * 60, delta=10 * 60 * WaitSketch.RELATIVE_ACCURACY)
+
+    def test_sweep_tickets(self):
+        u = User.objects.create_user(username='test_sweep_tickets', password='12345')
+        days = [datetime(2022, 1, 3).date(), datetime(2022, 1, 4).date()]
+        tickets = [Ticket(queue=self.queue, user=u, requested_time=datetime.combine(day, time(h), self.queue.tz)) for day in days for h in (9, 10, 11)]
+        for t in tickets:
+            t.save()
+        tickets[0].serve(now=datetime.combine(days[0], time(9, 5), self.queue.tz))
+        today = Ticket(queue=self.queue, user=u, requested_time=timezone.now() + timedelta(hours=1))
+        today.save()
+
+        self.assertEqual(self.queue.expire_stale_tickets(chunk_size=2), 5)
+        self.assertEqual(self.queue.tickets_set.filter(state=TicketState.OPEN).get(), today)
+        self.assertEqual(self.queue.slots_set.count(), 1)
+        expected = [(days[0], 0, 2, 1), (days[1], 0, 3, 0)]
+        self.assertEqual(list(self.queue.daily_stats.filter(day__in=days).order_by('day').values_list('day', 'open', 'expired', 'served')), expected)
+        QueueDailyStats.rebuild(self.queue)
+        self.assertEqual(list(self.queue.daily_stats.filter(day__in=days).order_by('day').values_list('day', 'open', 'expired', 'served')), expected)
+        self.assertEqual(self.queue.expire_stale_tickets(), 0)
+
+        data = self.query_stats('2022-01-03', '2022-01-04').json()
+        self.assertEqual(data['tickets'][4:], [['open', 0, 0], ['expired', 2, 3]])
+
+    def test_wait_sketch(self):
+        values = [i * 7 % 1000 for i in range(1000)]
+        sketch = WaitSketch.of(values[:500])
+        sketch.merge(WaitSketch.from_json(WaitSketch.of(values[500:]).to_json()))
+        self.assertEqual(sketch.count, 1000)
+        for q in (0.5, 0.9, 0.99):
+            expected = sorted(values)[int(q * 999)]
+            self.assertAlmostEqual(sketch.quantile(q), expected, delta=expected * WaitSketch.RELATIVE_ACCURACY)
+
+        # Values can also be removed
+        sketch.add(999, -1)
+        self.assertEqual(sketch.count, 999)
+        self.assertIsNone(WaitSketch().quantile(0.5))
+
+    def test_time_scales(self):
+        u = User.objects.create_user(username='test_time_scales', password='12345')
+        for day, h in [(3, 9), (3, 9), (3, 11), (11, 10), (31, 10)]:
+            requested_time = datetime(2022, 1, day, h, tzinfo=self.queue.tz)
+            Ticket(queue=self.queue, user=u, requested_time=requested_time).save()
+
+        data = self.query_stats('2022-01-03', '2022-01-03', 'hours').json()
+        self.assertEqual(data['timeScale'], 'hours')
+        self.assertEqual(len(data['tickets'][0]), 1 + 24)
+        self.assertEqual(data['tickets'][0][10], '2022-01-03 09:00')
+        self.assertEqual(data['tickets'][4][10:13], [2, 0, 1])
+
+        data = self.query_stats('2022-01-01', '2022-02-28', 'weeks').json()
+        self.assertEqual(data['tickets'][0][1:4], ['2021-12-27', '2022-01-03', '2022-01-10'])
+        self.assertEqual(data['tickets'][4][1:4], [0, 3, 1])
+
+        data = self.query_stats('2022-01-01', '2022-02-28', 'months').json()
+        self.assertEqual(data['tickets'], [
+            ['x', '2022-01-01', '2022-02-01'],
+            ['served', 0, 0],
+            ['canceledQueue', 0, 0],
+            ['canceledUser', 0, 0],
+            ['open', 5, 0],
+            ['expired', 0, 0],
+        ])
+
+        # Long ranges are made coarser
+        data = self.query_stats('2022-01-01', '2022-12-31', 'hours').json()
+        self.assertEqual(data['timeScale'], 'days')
+        data = self.query_stats('2020-01-01', '2022-12-31', 'days').json()
+        self.assertEqual(data['timeScale'], 'weeks')
+
+    def test_heatmap(self):
+        u = User.objects.create_user(username='test_heatmap', password='12345')
+        now = datetime.now(self.queue.tz)
+        last_monday = datetime.combine(now.date() - timedelta(days=now.weekday() + 7), time(9), self.queue.tz)
+        Ticket(queue=self.queue, user=u, requested_time=last_monday).save()
+        t = Ticket(queue=self.queue, user=u, requested_time=last_monday + timedelta(minutes=30))
+        t.save()
+        t.serve(now=last_monday + timedelta(minutes=40))
+        Ticket(queue=self.queue, user=u, requested_time=last_monday + timedelta(days=2, hours=5)).save()
+
+        url = reverse('queues:queue_stats_heatmap_api', args=[self.queue.id])
+        data = self.client.get(url, data={'weeks': 2}).json()
+        self.assertEqual(data['counts'][0][9], 2)
+        self.assertEqual(data['counts'][2][14], 1)
+        self.assertEqual(sum(map(sum, data['counts'])), 3)
+        self.assertEqual(data['servedRatio'][0][9], 0.5)
+        self.assertEqual(data['meanWait'][0][9], 10 * 60)
+
+        # Cached until the end of the week
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, data={'weeks': 2})
+        self.assertFalse(any('queues_ticket' in x['sql'] for x in ctx.captured_queries))
+
+        self.assertEqual(self.client.get(url, data={'weeks': 1000}).status_code, 400)
+
+    def test_conditional_requests(self):
+        u = User.objects.create_user(username='test_conditional_requests', password='12345')
+        res = self.query_stats('2022-01-03', '2022-01-10')
+        etag = res['ETag']
+        self.assertTrue(res.has_header('Last-Modified'))
+
+        # Nothing changed, the tickets are not even looked at
+        url = reverse('queues:queue_stats_api', args=[self.queue.id])
+        data = {'timeScale': 'days', 'from': '2022-01-03', 'to': '2022-01-10'}
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(url, data=data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertFalse(any('queues_ticket' in x['sql'] or 'dailystats' in x['sql'] for x in ctx.captured_queries))
+
+        # Any ticket change invalidates it
+        Ticket(queue=self.queue, user=u, requested_time=datetime(2022, 1, 4, 9, tzinfo=self.queue.tz)).save()
+        res = self.client.get(url, data=data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+
+
+class IndexTests(TestCase):
+    def assertUsesIndex(self, queryset, index: str):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+
+    def test_ticket_indexes(self):
+        u = User.objects.create_user(username='test_ticket_indexes', password='12345')
+        q = QQueue(name="test_ticket_indexes1")
+        q.save()
+        day = datetime(2022, 1, 3).date()
+
+        self.assertUsesIndex(q.get_open_tickets(day), 'ticket_queue_state_time_idx')
+        self.assertUsesIndex(u.tickets_set.order_by('-requested_time'), 'ticket_user_time_idx')
+        self.assertUsesIndex(q.slots_set.filter(day=day).order_by('start'), 'ticketslot_queue_day_idx')
+        self.assertUsesIndex(Ticket.objects.filter(remind_time__lte=timezone.now()).order_by('remind_time'), 'ticket_remind_idx')
+
+
+class PositionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queue = QQueue(name="test_positions")
+        self.queue.save()
+        self.user = User.objects.create_user(username='test_positions', password='12345')
+        self.day = datetime(2022, 1, 3).date()
+        self.now = datetime.combine(self.day, time(9), self.queue.tz)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tickets = [
+                Ticket.objects.create(queue=self.queue, user=self.user, requested_time=datetime.combine(self.day, time(9, i * 10), self.queue.tz))
+                for i in range(3)
+            ]
+
+    def get_position(self, ticket: Ticket) -> dict:
+        # Positions are only trusted for the current version of the queue
+        ticket.queue = QQueue.objects.get(id=self.queue.id)
+        return get_position(ticket, now=self.now)
+
+    def test_positions(self):
+        QQueue.objects.filter(id=self.queue.id).update(expected_time_per_ticket=15 * 60)
+        self.assertEqual([self.get_position(t)['position'] for t in self.tickets], [1, 2, 3])
+        last = self.get_position(self.tickets[2])
+        self.assertEqual(last['ahead'], 2)
+        self.assertEqual(last['eta'], self.now + timedelta(minutes=30))
+        self.assertEqual(last['waitSecs'], 30 * 60)
+        # Never before the requested time
+        self.assertEqual(self.get_position(self.tickets[0])['eta'], self.tickets[0].requested_time)
+
+        # Transitions move the slots, a position is one COUNT on their index
+        self.tickets[0].serve(now=self.now)
+        self.tickets[2].reschedule(datetime.combine(self.day, time(8), self.queue.tz))
+        extra = Ticket.objects.create(queue=self.queue, user=self.user, requested_time=datetime.combine(self.day, time(12), self.queue.tz))
+        moved = Ticket.objects.create(queue=self.queue, user=self.user, requested_time=datetime.combine(self.day, time(13), self.queue.tz))
+        moved.reschedule(datetime.combine(self.day + timedelta(days=1), time(9), self.queue.tz))
+        self.assertEqual(list(get_line(self.queue.id, self.day).values_list('ticket_id', flat=True)), [self.tickets[2].id, self.tickets[1].id, extra.id])
+        self.assertIsNone(self.get_position(self.tickets[0]))
+        ticket = self.tickets[1]
+        ticket.queue = QQueue.objects.get(id=self.queue.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_position(ticket, now=self.now)['position'], 2)
+        self.assertEqual(self.get_position(extra)['position'], 3)
+        self.assertEqual(self.get_position(moved)['position'], 1)
+        self.assertIn('ticketslot_queue_day_idx', get_line(self.queue.id, self.day).filter(start__lte=self.now).explain())
+
+        # Same requested time: served by id, as call_next does
+        same = [Ticket.objects.create(queue=self.queue, user=self.user, requested_time=self.now) for _ in range(2)]
+        self.assertEqual([self.get_position(t)['position'] for t in same], [2, 3])
+        self.assertEqual(QQueue.objects.get(id=self.queue.id).call_next(now=self.now), self.tickets[2])
+        self.assertEqual(QQueue.objects.get(id=self.queue.id).call_next(now=self.now), same[0])
+
+    def test_api(self):
+        url = reverse('queues:ticket_position_api', args=[self.tickets[1].id])
+        self.client.force_login(User.objects.create_user(username='test_positions_other', password='12345'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.user)
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['position'], 2)
+        self.assertEqual(res.json()['state'], TicketState.OPEN)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+        self.assertContains(self.client.get(reverse('queues:ticket_details', args=[self.tickets[1].id])), 'You are #<span id="ticket-position-number">2</span>')
+
+        self.tickets[1].cancel('user', "bye")
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(res.json()['position'])
+
+
+class BoardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.queue = QQueue(name="test_board")
+        self.queue.save()
+        user = User.objects.create_user(username='test_board', password='12345')
+        day = timezone.now().astimezone(self.queue.tz).date()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tickets = [
+                Ticket.objects.create(queue=self.queue, user=user, requested_time=datetime.combine(day, time(0, i), self.queue.tz))
+                for i in range(3)
+            ]
+        self.url = reverse('queues:queue_board_api', args=[self.queue.id])
+        self.token = board.make_board_token(self.queue)
+
+    def test_board(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.assertEqual(self.client.get(self.url, {'token': board.make_board_token(QQueue.objects.create(name="other"))}).status_code, 403)
+        self.assertEqual(self.client.get(self.url, {'token': self.token, 'wait': 1000}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('queues:queue_board', args=[self.queue.id]), {'token': self.token}).status_code, 200)
+
+        res = self.client.get(self.url, {'token': self.token})
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(res.json()['nowServing'])
+        self.assertEqual([x['number'] for x in res.json()['next']], [t.id for t in self.tickets])
+        self.assertEqual(res.json()['waiting'], 3)
+
+        # Polls are answered from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url, {'token': self.token}, HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+
+        # Recomputed by the transition itself
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tickets[0].serve()
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url, {'token': self.token}, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['nowServing']['number'], self.tickets[0].id)
+        self.assertEqual([x['number'] for x in res.json()['next']], [t.id for t in self.tickets[1:]])
+
+    def test_board_reset(self):
+        owner = User.objects.create_user(username='test_board_reset', password='12345')
+        QueueUser.objects.create(queue=self.queue, user=owner, role=QueueUserRole.OWNER)
+        self.client.force_login(owner)
+        self.assertEqual(self.client.get(self.url, {'token': self.token}).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(reverse('queues:queue_board_reset', args=[self.queue.id])).status_code, 302)
+        self.assertEqual(self.client.get(self.url, {'token': self.token}).status_code, 403)
+        self.queue.refresh_from_db()
+        self.assertEqual(self.client.get(self.url, {'token': board.make_board_token(self.queue)}).status_code, 200)
+
+    def test_long_poll(self):
+        entry = board.get_board(self.queue.id)
+        # Nothing changes
+        self.assertEqual(async_to_sync(board.wait_board)(self.queue.id, entry['etag'], 0.1)['etag'], entry['etag'])
+
+        def change():
+            cache.set(board.board_cache_key(self.queue.id), {**entry, 'etag': 'changed'})
+            events.get_broker().publish(events.queue_channel(self.queue.id), {'type': 'served', 'tickets': []})
+        Timer(0.1, change).start()
+        self.assertEqual(async_to_sync(board.wait_board)(self.queue.id, entry['etag'], 10)['etag'], 'changed')
+
+
+class SearchTests(TestCase):
+    def search(self, text: str) -> list:
+        return [q.name for q in search_queues(QQueue.objects.all(), text)]
+
+    def test_search(self):
+        QQueue.objects.create(name="Pizzeria da Mario", description="Pizza and pasta", join_mode=JoinMode.PUBLIC)
+        QQueue.objects.create(name="Barber", description="Next to the pizzeria", join_mode=JoinMode.PUBLIC)
+        QQueue.objects.create(name="Café Crème", description="", join_mode=JoinMode.PUBLIC)
+        private = QQueue.objects.create(name="Pizza club", join_mode=JoinMode.INVITE)
+
+        # Names weigh more than descriptions, words are prefixes
+        result = self.search("pizz")
+        self.assertEqual(set(result[:2]), {"Pizza club", "Pizzeria da Mario"})
+        self.assertEqual(result[2:], ["Barber"])
+        self.assertEqual(self.search("pizzeria"), ["Pizzeria da Mario", "Barber"])
+        self.assertEqual(self.search("mario PIZZ"), ["Pizzeria da Mario"])
+        self.assertEqual(self.search("cafe creme"), ["Café Crème"])
+        # User input is never parsed as a query
+        self.assertEqual(self.search('pizzeria" OR NEAR(*'), [])
+        self.assertEqual(self.search("  ---  "), [])
+
+        # The index follows the queues
+        private.name = "Chess club"
+        private.save()
+        self.assertNotIn("Pizza club", self.search("pizza"))
+        self.assertEqual(self.search("chess"), ["Chess club"])
+        private.delete()
+        self.assertEqual(self.search("chess"), [])
+
+        # Combined with the visibility rules
+        user = User.objects.create_user(username='test_search', password='12345')
+        QQueue.objects.create(name="Pizza hidden", join_mode=JoinMode.FRIENDS_ONLY)
+        queryset = search_queues(QQueue.objects.visible_to(user), "pizza")
+        self.assertEqual([q.name for q in queryset], ["Pizzeria da Mario"])
+
+    @skipUnless(connection.vendor == 'sqlite', "FTS5 index, PostgreSQL is covered by test_search_plan_postgresql")
+    def test_search_plan_sqlite(self):
+        QQueue.objects.create(name="Pizzeria da Mario", join_mode=JoinMode.PUBLIC)
+        user = User.objects.create_user(username='test_search_plan', password='12345')
+        # The index drives the query
+        self.assertIn('VIRTUAL TABLE', search_queues(QQueue.objects.visible_to(user), "pizza").explain())
+
+    @skipUnless(connection.vendor == 'postgresql', "GIN index, SQLite is covered by test_search_plan_sqlite")
+    def test_search_plan_postgresql(self):
+        QQueue.objects.create(name="Pizzeria da Mario", join_mode=JoinMode.PUBLIC)
+        user = User.objects.create_user(username='test_search_plan', password='12345')
+        # The table is too small for the planner to pick the index by itself
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        self.assertIn('queuesearchdocument_document_idx', search_queues(QQueue.objects.visible_to(user), "pizza").explain())
+
+    def test_pagination(self):
+        for i in range(SEARCH_PAGE_SIZE + 5):
+            QQueue.objects.create(name=f"Shop {i:02}", join_mode=JoinMode.PUBLIC)
+        url = reverse('queues:search')
+        res = self.client.get(url, {'q': 'shop'})
+        self.assertEqual(len(res.context['result']), SEARCH_PAGE_SIZE)
+        self.assertEqual(res.context['result'].paginator.count, SEARCH_PAGE_SIZE + 5)
+        res = self.client.get(url, {'q': 'shop', 'page': 2})
+        self.assertEqual([q.name for q in res.context['result']], [f"Shop {i:02}" for i in range(SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE + 5)])
+
+
+class FakePushServer(ThreadingHTTPServer):
+    """
+    Local stand-in for a push service, endpoints under /gone/ answer 410 and under /fail/ answer 500
+    """
+    def __init__(self):
+        self.received = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.received.append((self.path, self.headers, body))
+                code = 410 if self.path.startswith('/gone/') else 500 if self.path.startswith('/fail/') else 201
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_notifications', password='12345')
+        self.queue = QQueue(name="test_notifications1")
+        self.queue.save()
+        now = datetime.now(self.queue.tz).replace(hour=12, minute=0)
+        self.first = Ticket(queue=self.queue, user=self.user, requested_time=now - timedelta(minutes=10))
+        self.first.save()
+        self.second = Ticket(queue=self.queue, user=self.user, requested_time=now)
+        self.second.save()
+
+        self.server = FakePushServer()
+        self.addCleanup(self.server.stop)
+        self.engine = PushEngine(max_workers=4)
+
+    def subscribe(self, path: str) -> SubscriptionInfo:
+        key = ec.generate_private_key(ec.SECP256R1())
+        public = key.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+        b64 = lambda x: base64.urlsafe_b64encode(x).strip(b'=').decode()
+        subscription = SubscriptionInfo.objects.create(
+            browser='test',
+            endpoint=self.server.url(path),
+            p256dh=b64(public),
+            auth=b64(os.urandom(16)),
+        )
+        PushInformation.objects.create(user=self.user, subscription=subscription)
+        return subscription
+
+    def test_outbox(self):
+        self.subscribe('/ok/1')
+        self.subscribe('/ok/2')
+        gone = self.subscribe('/gone/1')
+
+        self.first.serve()
+        # Nothing is sent while serving
+        self.assertEqual(self.server.received, [])
+        n = Notification.objects.get()
+        self.assertEqual(n.payload['url'], reverse('queues:ticket_details', args=[self.second.id]))
+
+        self.assertEqual(deliver_due(engine=self.engine), 1)
+        self.assertEqual(sorted(x[0] for x in self.server.received), ['/gone/1', '/ok/1', '/ok/2'])
+        self.assertTrue(all(x[1]['Authorization'].startswith('vapid ') for x in self.server.received))
+        n.refresh_from_db()
+        self.assertEqual(n.state, NotificationState.SENT)
+        self.assertEqual(deliver_due(engine=self.engine), 0)
+        # Dead subscriptions are pruned
+        self.assertFalse(SubscriptionInfo.objects.filter(id=gone.id).exists())
+
+        # Connections and VAPID headers are reused
+        self.assertEqual(len(self.engine._sessions), 1)
+        headers = self.engine.get_vapid_headers(self.server.url(''))
+        self.assertIs(headers, self.engine.get_vapid_headers(self.server.url('')))
+
+    def test_dedupe(self):
+        now = datetime.now(self.queue.tz).replace(hour=12, minute=0)
+        later = [Ticket(queue=self.queue, user=self.user, requested_time=now + timedelta(minutes=10 * i)) for i in range(1, 4)]
+        for t in later:
+            t.save()
+
+        # The head of the line is notified once, however many tickets behind it close
+        for t in later:
+            t.cancel('user', "bye")
+        self.assertEqual(list(Notification.objects.values_list('ticket_id', 'kind')), [(self.first.id, NotificationKind.NEXT)])
+
+        self.first.serve()
+        self.second.cancel('queue', "closing")
+        self.assertEqual(list(Notification.objects.order_by('id').values_list('ticket_id', flat=True)), [self.first.id, self.second.id])
+
+        # Direct calls are idempotent too
+        Notification.notify(self.second, NotificationKind.NEXT, {})
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_reminders(self):
+        # A queue of its own, the tickets of setUp would be reminded too before noon
+        self.queue = QQueue.objects.create(name="test_reminders")
+        now = timezone.now()
+        ticket = Ticket(queue=self.queue, user=self.user, requested_time=now + timedelta(hours=2))
+        ticket.save()
+        self.assertIsNone(ticket.remind_time)
+
+        # Enabling reminders schedules the future tickets
+        self.queue.reminder_minutes = 30
+        self.queue.save()
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.remind_time, ticket.requested_time - timedelta(minutes=30))
+        late = Ticket(queue=self.queue, user=self.user, requested_time=now + timedelta(hours=3))
+        late.save()
+        self.assertEqual(late.remind_time, late.requested_time - timedelta(minutes=30))
+
+        self.assertEqual(remind_due(now=now), 0)
+        self.assertEqual(remind_due(now=now + timedelta(minutes=95)), 1)
+        n = Notification.objects.get(kind=NotificationKind.REMINDER)
+        self.assertEqual(n.ticket_id, ticket.id)
+        self.assertEqual(n.payload['head'], f'{self.queue.name} in 25 minutes')
+        ticket.refresh_from_db()
+        self.assertIsNone(ticket.remind_time)
+        self.assertEqual(remind_due(now=now + timedelta(minutes=95)), 0)
+
+        # Rescheduling does not remind a ticket twice, closed tickets are not reminded
+        self.queue.reminder_minutes = 10
+        self.queue.save()
+        ticket.refresh_from_db()
+        self.assertIsNone(ticket.remind_time)
+        late.cancel('user', "bye")
+        self.assertIsNone(late.remind_time)
+        self.assertEqual(remind_due(now=now + timedelta(hours=4)), 0)
+        self.assertEqual(Notification.objects.filter(kind=NotificationKind.REMINDER).count(), 1)
+
+    def test_worker_lease(self):
+        now = timezone.now()
+        self.assertTrue(WorkerLease.acquire('job', 'a', timedelta(seconds=30), now=now))
+        self.assertFalse(WorkerLease.acquire('job', 'b', timedelta(seconds=30), now=now + timedelta(seconds=10)))
+        # Renewed by its owner
+        self.assertTrue(WorkerLease.acquire('job', 'a', timedelta(seconds=30), now=now + timedelta(seconds=20)))
+        self.assertFalse(WorkerLease.acquire('job', 'b', timedelta(seconds=30), now=now + timedelta(seconds=40)))
+        # Taken over once expired
+        self.assertTrue(WorkerLease.acquire('job', 'b', timedelta(seconds=30), now=now + timedelta(seconds=60)))
+        WorkerLease.release('job', 'a')
+        self.assertFalse(WorkerLease.acquire('job', 'a', timedelta(seconds=30), now=now + timedelta(seconds=61)))
+        WorkerLease.release('job', 'b')
+        self.assertTrue(WorkerLease.acquire('job', 'a', timedelta(seconds=30), now=now + timedelta(seconds=62)))
+
+    def test_retries(self):
+        self.subscribe('/fail/1')
+        self.first.cancel('user', "bye")
+        now = timezone.now()
+        self.assertEqual(deliver_due(now=now, engine=self.engine), 1)
+        n = Notification.objects.get()
+        self.assertEqual(n.state, NotificationState.PENDING)
+        self.assertEqual(n.attempts, 1)
+        self.assertIn("500", n.last_error)
+        # Backing off
+        self.assertEqual(deliver_due(now=now + timedelta(seconds=1), engine=self.engine), 0)
+        for i in range(1, MAX_ATTEMPTS):
+            now += timedelta(days=1)
+            self.assertEqual(deliver_due(now=now, engine=self.engine), 1)
+        n.refresh_from_db()
+        self.assertEqual(n.state, NotificationState.FAILED)
+        self.assertEqual(len(self.server.received), MAX_ATTEMPTS)
+
+    def test_partial_delivery(self):
+        ok = self.subscribe('/ok/1')
+        self.subscribe('/fail/1')
+        self.first.cancel('user', "bye")
+        now = timezone.now()
+        for i in range(MAX_ATTEMPTS):
+            self.assertEqual(deliver_due(now=now, engine=self.engine), 1)
+            now += timedelta(days=1)
+        n = Notification.objects.get()
+        self.assertEqual(n.state, NotificationState.FAILED)
+        self.assertEqual(n.delivered_to, [ok.id])
+        # Only the failing device is retried
+        paths = [x[0] for x in self.server.received]
+        self.assertEqual(paths.count('/ok/1'), 1)
+        self.assertEqual(paths.count('/fail/1'), MAX_ATTEMPTS)
+
+
+class EventTests(TestCase):
+    def setUp(self):
+        self.queue = QQueue(name="test_events")
+        self.queue.save()
+        self.user = User.objects.create_user(username='test_events', password='12345')
+        day = timezone.now().astimezone(self.queue.tz).date()
+        self.first = Ticket(queue=self.queue, user=self.user, requested_time=datetime.combine(day, time(0), self.queue.tz))
+        self.first.save()
+        self.second = Ticket(queue=self.queue, user=self.user, requested_time=datetime.combine(day, time(0), self.queue.tz))
+        self.second.save()
+        self.channel = events.queue_channel(self.queue.id)
+
+    def listen(self) -> list:
+        received = []
+        self.addCleanup(events.get_broker().subscribe(self.channel, received.append))
+        return received
+
+    def test_published_on_commit(self):
+        received = self.listen()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.first.serve()
+            self.assertEqual(received, [])
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]['type'], 'served')
+        self.assertEqual(received[0]['tickets'][0]['id'], self.first.id)
+        self.assertEqual(received[0]['tickets'][0]['state'], TicketState.SERVED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ticket(queue=self.queue, user=self.user, requested_time=self.first.requested_time).save()
+        self.assertEqual(received[1]['type'], 'created')
+        self.assertEqual(received[1]['tickets'][0]['user']['id'], self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.queue.close_day(self.first.get_day(), "closed"), 2)
+        self.assertEqual(received[2]['type'], 'cancelled')
+        self.assertEqual(len(received[2]['tickets']), 2)
+
+    def test_tokens(self):
+        owner = User.objects.create_user(username='test_events_owner', password='12345')
+        role = QueueUser.objects.create(queue=self.queue, user=owner, role=QueueUserRole.OWNER)
+        staff = events.read_token(events.make_token(self.queue.id, user_id=owner.id), self.queue.id)
+        self.assertIsNotNone(staff)
+        own = events.read_token(events.make_token(self.queue.id, self.first.id), self.queue.id)
+        self.assertIsNone(events.read_token(events.make_token(self.queue.id), QQueue.objects.create(name="other").id))
+        self.assertIsNone(events.read_token('forged', self.queue.id))
+        self.assertIsNone(events.read_token(None, self.queue.id))
+        # Staff tokens only work while their user manages the queue
+        self.assertIsNone(events.read_token(events.make_token(self.queue.id, user_id=self.user.id), self.queue.id))
+        self.assertIsNone(events.read_token(events.make_token(self.queue.id), self.queue.id))
+
+        message = {'type': 'served', 'tickets': [{'id': self.second.id}]}
+        self.assertEqual(events.filter_message(message, staff), message)
+        self.assertEqual(events.filter_message(message, own), {'type': 'queue', 'tickets': []})
+        message = {'type': 'served', 'tickets': [{'id': self.first.id}, {'id': self.second.id}]}
+        self.assertEqual(events.filter_message(message, own), {'type': 'served', 'tickets': [{'id': self.first.id}]})
+
+        url = reverse('queues:queue_events', args=[self.queue.id])
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, {'token': 'forged'}).status_code, 403)
+
+        # The manage page gives a staff token, and the day of the queue
+        self.client.force_login(owner)
+        res = self.client.get(reverse('queues:queue_manage', args=[self.queue.id]))
+        self.assertEqual(res.context['today'], timezone.now().astimezone(self.queue.tz).date())
+        token = parse_qs(urlparse(res.context['events_url']).query)['token'][0]
+        self.assertEqual(events.read_token(token, self.queue.id)['u'], owner.id)
+        role.delete()
+        self.assertIsNone(events.read_token(token, self.queue.id))
+
+    def test_sync_stream(self):
+        stream = events.stream_sync(self.queue.id, {'t': None}, max_secs=0)
+        self.assertEqual(next(stream), events.HEARTBEAT)
+        self.assertEqual(events.get_broker().subscriber_count(self.channel), 1)
+        self.assertEqual(list(stream), [])
+        self.assertEqual(events.get_broker().subscriber_count(self.channel), 0)
+
+    def test_event_stream_app(self):
+        async def django_app(scope, receive, send):
+            sent.append('django')
+
+        async def request(token: str):
+            scope = {
+                'type': 'http',
+                'path': f'/queue/{self.queue.id}/events',
+                'query_string': f'token={token}'.encode(),
+            }
+            requests = asyncio.Queue()
+            await requests.put({'type': 'http.request', 'body': b''})
+
+            async def send(message):
+                sent.append(message)
+                # Publishes once the client is subscribed and has got the first heartbeat
+                if message.get('body') == events.HEARTBEAT and not published:
+                    published.append(True)
+                    await asyncio.get_running_loop().run_in_executor(None, events.get_broker().publish, self.channel, {
+                        'type': 'served',
+                        'tickets': [{'id': self.first.id}, {'id': self.second.id}],
+                    })
+                elif message.get('body', b'').startswith(b'event:'):
+                    await requests.put({'type': 'http.disconnect'})
+
+            await asyncio.wait_for(app(scope, requests.get, send), timeout=5)
+
+        app = events.EventStreamApp(django_app)
+        sent, published = [], []
+        asyncio.run(app({'type': 'http', 'path': '/'}, None, None))
+        self.assertEqual(sent, ['django'])
+
+        sent = []
+        asyncio.run(request('forged'))
+        self.assertEqual(sent[0]['status'], 403)
+
+        sent = []
+        asyncio.run(request(events.make_token(self.queue.id, self.second.id)))
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(sent[-1]['body'], events.format_message({'type': 'served', 'tickets': [{'id': self.second.id}]}))
+        self.assertEqual(events.get_broker().subscriber_count(self.channel), 0)
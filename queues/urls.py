@@ -24,19 +24,28 @@ urlpatterns = [
     path("queue/<uuid:pk>/manage", v.queue_manage, name="queue_manage"),
     path("queue/<uuid:pk>/manage/exception", v.queue_manage_exception, name="queue_add_exception"),
     path("queue/<uuid:pk>/manage/serve/<int:ticket>", v.queue_manage_serve, name="queue_manage_serve_ticket"),
+    path("queue/<uuid:pk>/manage/next", v.queue_manage_call_next, name="queue_manage_call_next"),
+    # Server-sent events of the queue (see queues.events)
+    path("queue/<uuid:pk>/events", v.queue_events, name="queue_events"),
     path("queue/<uuid:pk>/manage/cancel/<int:ticket>", v.queue_manage_cancel, name="queue_manage_cancel_ticket"),
+    # Public display board, for kiosks
+    path("queue/<uuid:pk>/board", v.queue_board, name="queue_board"),
+    path("queue/<uuid:pk>/board_api", v.api_queue_board, name="queue_board_api"), # AJAX
+    path("queue/<uuid:pk>/manage/board_reset", v.queue_board_reset, name="queue_board_reset"),
     path("queue/<uuid:pk>/book", v.queue_book, name="queue_book"),
     path("queue/<uuid:pk>/book_api", v.api_book_dates, name="queue_book_api"), # AJAX
     path("queue/<uuid:pk>/report", v.queue_report, name="queue_report"),
     path("queue/<uuid:pk>/report_details", v.queue_report_review, name="queue_report_review"),
     path("queue/<uuid:pk>/stats", sv.queue_stats, name="queue_stats"),
     path("queue/<uuid:pk>/stats_api", sv.api_query, name="queue_stats_api"),
+    path("queue/<uuid:pk>/stats_heatmap_api", sv.api_heatmap, name="queue_stats_heatmap_api"),
 
     path("reports", v.report_list, name="report_list"),
 
     path("ticket/", v.list_my_tickets, name="ticket_list"),
     path("ticket/<int:pk>", v.ticket_details, name="ticket_details"),
     path("ticket/<int:pk>/cancel", v.ticket_cancel, name="ticket_cancel"),
+    path("ticket/<int:pk>/position_api", v.api_ticket_position, name="ticket_position_api"), # AJAX
 
     path("search", v.queue_search, name="search")
 ]
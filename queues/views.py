@@ -3,21 +3,32 @@ from datetime import date, datetime, time
 import random
 from typing import Optional, Tuple
 from uuid import uuid4
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse
-from django.http import Http404, HttpRequest, HttpResponseForbidden, JsonResponse
+from django.http import Http404, HttpRequest, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin, UserPassesTestMixin
 from django.contrib import messages
+from django.core.paginator import Paginator
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView, CreateView, UpdateView
 from django.forms.models import modelform_factory
 from django.utils import timezone
 from django.db import connection
+from django.db.models import Exists, OuterRef
 
-from users.models import User
+from core.utils import conditional_response, make_etag
+from users.models import User, UserFriend
 
+from . import board, events
 from .forms import MessageForm, QueueRangeExceptionForm, ScheduleForm, AddAdminForm, ExistingUserForm, BookQueueForm
-from .models import WEEKDAY_NAMES, JoinMode, QQueue, QueueOpenException, QueueUser, QueueUserRole, Ticket, TicketState, UserQueueReport
+from .models import WEEKDAY_NAMES, JoinMode, QQueue, QueueOpenException, QueueUser, QueueUserRole, Ticket, TicketState, TicketStateError, UserQueueReport
+from .positions import get_position
+from .search import SEARCH_PAGE_SIZE, search_queues
+
+# Maximum number of days that can be requested at once from api_book_dates
+MAX_BOOK_RANGE_DAYS = 90
 
 def format_time(t: time) -> str:
     return t.strftime('%H:%M')
@@ -46,22 +57,21 @@ def suggest_queue(request: HttpRequest) -> Optional[Tuple[str, QQueue]]:
     state = None
 
     if user.is_authenticated:
-        friend_queues = QQueue.objects.filter(join_mode__in=[JoinMode.PUBLIC, JoinMode.FRIENDS_ONLY], is_privacy_hidden=False)\
-                .filter(tickets__friends__id__exact=user.id)\
-                .distinct()
-        friend_queues = list(filter(lambda x: x.is_visible_by(user), friend_queues))
-
-        if friend_queues:
-            choice = random.choice(friend_queues)
+        # Queues with a ticket of someone that has the user as a friend, picked by the database
+        friend_tickets = Ticket.objects.filter(queue=OuterRef('pk'), user__in=UserFriend.objects.filter(user_to=user).values('user_from'))
+        choice = QQueue.objects.visible_to(user)\
+                .filter(join_mode__in=[JoinMode.PUBLIC, JoinMode.FRIENDS_ONLY], is_privacy_hidden=False)\
+                .filter(Exists(friend_tickets))\
+                .order_by('?')\
+                .first()
+
+        if choice is not None:
             state = 'friends_are_using'
 
     if state is None:
-        queryset = QQueue.objects.filter(join_mode=JoinMode.PUBLIC)
-        try:
-            choice = random.choice(queryset)
+        choice = QQueue.objects.filter(join_mode=JoinMode.PUBLIC).order_by('?').first()
+        if choice is not None:
             state = 'discover'
-        except:
-            pass  # There are no public queues
     return (state, choice) if state is not None else None
 
 
@@ -79,13 +89,13 @@ def list_my_queues(request: HttpRequest):
 def queue_search(request: HttpRequest):
     query = request.GET.get('q') or ''
     if query != '':
-        result = list(QQueue.objects.filter(name__contains=query).exclude(join_mode=JoinMode.URL_ONLY))
-        result = list(filter(lambda x: x.join_mode != JoinMode.URL_ONLY and x.is_visible_by(request.user), result))
+        result = search_queues(QQueue.objects.visible_to(request.user).exclude(join_mode=JoinMode.URL_ONLY), query)
     else:
-        result = []
+        result = QQueue.objects.none()
+    page = Paginator(result, SEARCH_PAGE_SIZE).get_page(request.GET.get('page'))
 
     return render(request, 'queues/search.html', context={
-        'result': result,
+        'result': page,
         'query': query,
         'disable_search': True,
     })
@@ -99,10 +109,10 @@ class QueueDetailView(QueueVisibleMixin, DetailView):
         data = super().get_context_data(**kwargs)
         queue = data['object']
 
-        raw_schedule = {x.day: [x.from_time, x.to_time] for x in queue.schedule.all()}
+        weekly = queue.get_schedule().weekly
         schedule = []
         for i, (_, awesome_name) in enumerate(WEEKDAY_NAMES):
-            x = raw_schedule.get(i)
+            x = weekly[i]
             schedule.append({
                 'name': awesome_name,
                 'times': format_time_range(x),
@@ -144,7 +154,7 @@ class QueueDetailView(QueueVisibleMixin, DetailView):
 
 class QueueCreateView(ModelFormWidgetMixin, LoginRequiredMixin, CreateView):
     model = QQueue
-    fields = ['name', 'description', 'tz', 'image', 'is_privacy_hidden', 'join_mode', 'fixed_ticket_time_minutes']
+    fields = ['name', 'description', 'tz', 'image', 'is_privacy_hidden', 'join_mode', 'fixed_ticket_time_minutes', 'reminder_minutes']
     template_name = "queues/create.html"
     labels = {
         'fixed_ticket_time_minutes': 'Fixed time per ticket in minutes (leave blank if not needed)'
@@ -171,7 +181,7 @@ class QueueCreateView(ModelFormWidgetMixin, LoginRequiredMixin, CreateView):
 
 class QueueUpdateView(ModelFormWidgetMixin, LoginRequiredMixin, UpdateView):
     model = QQueue
-    fields = ['name', 'description', 'tz', 'image', 'join_mode', 'fixed_ticket_time_minutes']
+    fields = ['name', 'description', 'tz', 'image', 'join_mode', 'fixed_ticket_time_minutes', 'reminder_minutes']
     template_name = "queues/edit.html"
     labels = {
         'fixed_ticket_time_minutes': 'Fixed time per ticket in minutes (leave blank if not needed)'
@@ -284,7 +294,7 @@ def queue_invite(request: HttpRequest, pk: uuid4):
         raise Http404()
 
     if queue.join_mode != JoinMode.INVITE:
-        return redirect(reverse('queue:details', args=[pk]))
+        return redirect(reverse('queues:queue_details', args=[pk]))
 
     if request.method == 'POST':
         form = ExistingUserForm(request.POST)
@@ -334,16 +344,7 @@ def queue_book(request: HttpRequest, pk: uuid4):
         'error': error,
     })
 
-def api_book_dates(request: HttpRequest, pk: uuid4):
-    queue = get_object_or_404(QQueue, id=pk)
-
-    if not queue.is_visible_by(request.user):
-        return HttpResponseForbidden()
-
-    day = datetime.strptime(request.GET['day'], '%Y-%m-%d').date()
-
-    bookable = queue.get_bookable_times(day)
-
+def format_bookable(bookable) -> dict:
     res = {}
     if bookable is None:
         res['state'] = 'closed'
@@ -355,36 +356,40 @@ def api_book_dates(request: HttpRequest, pk: uuid4):
     else:
         res['state'] = 'range'
         res['range'] = format_time_range(bookable)
+    return res
 
-    return JsonResponse(res)
-
-
-def queue_invite(request: HttpRequest, pk: uuid4):
+def api_book_dates(request: HttpRequest, pk: uuid4):
     queue = get_object_or_404(QQueue, id=pk)
 
-    if queue.get_user_role(request.user) not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
-        raise Http404()
+    if not queue.is_visible_by(request.user):
+        return HttpResponseForbidden()
 
-    if request.method == 'POST':
-        form = ExistingUserForm(request.POST)
-        if form.is_valid():
-            user = queue.users_set.filter(user=user).first()
-            if user is not None:
-                form.add_error('username', 'Already invited')
-            else:
-                QueueUser(
-                    queue=queue,
-                    user=form.cleaned_data['user'],
-                    role=QueueUserRole.INVITED,
-                ).save()
-                return redirect(reverse('queues:queue_details', args=[pk]))
-    else:
-        form = ExistingUserForm()
+    datefmt = '%Y-%m-%d'
+    try:
+        if 'from' in request.GET:
+            # Range query: { days: { day: state } } for every day in [from, to]
+            start = datetime.strptime(request.GET['from'], datefmt).date()
+            end = datetime.strptime(request.GET['to'], datefmt).date()
+        else:
+            start = end = datetime.strptime(request.GET['day'], datefmt).date()
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    if not (0 <= (end - start).days < MAX_BOOK_RANGE_DAYS):
+        return HttpResponseBadRequest()
+
+    def compute():
+        if 'from' in request.GET:
+            bookable = queue.get_bookable_times_range(start, end)
+            return JsonResponse({
+                'days': {day.strftime(datefmt): format_bookable(x) for day, x in bookable.items()},
+            })
+        return JsonResponse(format_bookable(queue.get_bookable_times(start)))
 
-    return render(request, 'queues/invite.html', context={
-        'queue': queue,
-        'form': form,
-    })
+    # Today's times also depend on the current time (past times can't be booked)
+    now = datetime.now(queue.tz)
+    clock = now.strftime('%H:%M') if start <= now.date() <= end else now.date()
+    etag = make_etag(queue.id, queue.version, clock, timezone.get_current_timezone_name(), sorted(request.GET.items()))
+    return conditional_response(request, etag, None, compute, private=True)
 
 def queue_manage(request: HttpRequest, pk: uuid4):
     queue = get_object_or_404(QQueue, id=pk)
@@ -393,19 +398,10 @@ def queue_manage(request: HttpRequest, pk: uuid4):
     if user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
         raise Http404()
 
-    now = timezone.localtime()
-    open_range = queue.get_open_range(now.date())
+    now = datetime.now(queue.tz)
+    state, open_range = queue.get_service_state(now)
 
-    if open_range is None:
-        state = 'never_open'
-    elif datetime.combine(now.date(), open_range[0], queue.tz) > now:
-        state = 'not_open_yet'
-    elif datetime.combine(now.date(), open_range[1], queue.tz) < now:
-        state = 'closed'
-    else:
-        state = 'open'
-
-    tickets = queue.tickets_set.filter(state=TicketState.OPEN, requested_time__date=now.date()).order_by('requested_time')
+    tickets = queue.get_open_tickets(now.date())
     tickets = [copy(t) for t in tickets]
     for t in tickets:
         t.time = 'No time' if t.requested_time.time() == time(0) else format_time(t.requested_time.astimezone(queue.tz))
@@ -416,8 +412,67 @@ def queue_manage(request: HttpRequest, pk: uuid4):
         'state': state,
         'open_range': format_time_range(open_range),
         'user_role': user_role,
+        'today': now.date(),
+        'events_url': get_events_url(queue.id, user_id=request.user.id),
+        'board_url': f"{reverse('queues:queue_board', args=[queue.id])}?token={board.make_board_token(queue)}",
     })
 
+def queue_board(request: HttpRequest, pk: uuid4):
+    # Public display board (kiosks), authorized by the token of the link shown on the manage page
+    token = request.GET.get('token')
+    if not board.check_board_token(token, pk, board.get_board(pk)):
+        return HttpResponseForbidden()
+    return render(request, 'queues/board.html', context={
+        'api_url': f"{reverse('queues:queue_board_api', args=[pk])}?token={token}",
+        'long_poll_secs': board.BOARD_LONG_POLL_SECS,
+    })
+
+async def api_queue_board(request: HttpRequest, pk: uuid4):
+    # Async: under ASGI a display waiting for the board to change does not hold a worker thread
+    entry = await sync_to_async(board.get_board)(pk)
+    if not board.check_board_token(request.GET.get('token'), pk, entry):
+        return HttpResponseForbidden()
+
+    # Input: { token, wait? }, with If-None-Match and wait the request is held until the board changes
+    try:
+        wait = int(request.GET.get('wait', 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not (0 <= wait <= board.BOARD_LONG_POLL_SECS):
+        return HttpResponseBadRequest()
+
+    # Served from the cache, the board is precomputed by the ticket transitions
+    if wait > 0 and request.headers.get('If-None-Match') == entry['etag']:
+        entry = await board.wait_board(pk, entry['etag'], wait)
+    if entry is None:
+        raise Http404()
+    return conditional_response(request, entry['etag'], entry['time'], lambda: JsonResponse(entry['board']))
+
+@require_POST
+def queue_board_reset(request: HttpRequest, pk: uuid4):
+    queue = get_object_or_404(QQueue, id=pk)
+
+    if queue.get_user_role(request.user) != QueueUserRole.OWNER:
+        raise Http404()
+
+    queue.rotate_board_token()
+    messages.success(request, "The previous board links no longer work", "Display board")
+    return redirect(reverse('queues:queue_manage', args=[pk]))
+
+def get_events_url(queue_id, ticket_id: Optional[int]=None, user_id: Optional[int]=None) -> str:
+    # The stream is authorized by a signed token, so that it can be served without a session (see queues.events)
+    return f"{reverse('queues:queue_events', args=[queue_id])}?token={events.make_token(queue_id, ticket_id, user_id)}"
+
+def queue_events(request: HttpRequest, pk: uuid4):
+    # Fallback for WSGI servers, under ASGI queues.events.EventStreamApp answers before Django
+    scope = events.read_token(request.GET.get('token'), pk)
+    if scope is None:
+        return HttpResponseForbidden()
+    res = StreamingHttpResponse(events.stream_sync(pk, scope), content_type='text/event-stream')
+    res['Cache-Control'] = 'no-cache'
+    res['X-Accel-Buffering'] = 'no'
+    return res
+
 def queue_manage_serve(request: HttpRequest, pk: uuid4, ticket: int):
     queue = get_object_or_404(QQueue, id=pk)
 
@@ -425,17 +480,36 @@ def queue_manage_serve(request: HttpRequest, pk: uuid4, ticket: int):
     if user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
         raise Http404()
 
-    ticket = get_object_or_404(Ticket, id=ticket)
+    ticket = get_object_or_404(Ticket, id=ticket, queue=queue)
     if ticket.state != TicketState.OPEN:
         return redirect(reverse('queues:queue_manage', args=[pk]))
 
     if request.method == 'POST':
-        ticket.serve()
+        try:
+            ticket.serve()
+        except TicketStateError:
+            # Served (or cancelled) by someone else in the meantime
+            messages.warning(request, "The ticket was already closed", "Warning")
         return redirect(reverse('queues:queue_manage', args=[pk]))
     return render(request, 'queues/manage_serve.html', context={
         'ticket': ticket,
     })
 
+@require_POST
+def queue_manage_call_next(request: HttpRequest, pk: uuid4):
+    queue = get_object_or_404(QQueue, id=pk)
+
+    user_role = queue.get_user_role(request.user)
+    if user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
+        raise Http404()
+
+    ticket = queue.call_next()
+    if ticket is None:
+        messages.info(request, "Nobody is waiting", "Call next")
+    else:
+        messages.success(request, f"Serving {ticket.user.first_name} {ticket.user.last_name}", "Call next")
+    return redirect(reverse('queues:queue_manage', args=[pk]))
+
 def queue_manage_cancel(request: HttpRequest, pk: uuid4, ticket: int):
     queue = get_object_or_404(QQueue, id=pk)
 
@@ -443,7 +517,7 @@ def queue_manage_cancel(request: HttpRequest, pk: uuid4, ticket: int):
     if user_role not in [QueueUserRole.OWNER, QueueUserRole.EMPLOYEE]:
         raise Http404()
 
-    ticket = get_object_or_404(Ticket, id=ticket)
+    ticket = get_object_or_404(Ticket, id=ticket, queue=queue)
 
     if ticket.state != TicketState.OPEN:
         return redirect(reverse('queues:queue_manage', args=[pk]))
@@ -453,7 +527,10 @@ def queue_manage_cancel(request: HttpRequest, pk: uuid4, ticket: int):
 
         if form.is_valid():
             mex = form.cleaned_data['message']
-            ticket.cancel('queue', mex)
+            try:
+                ticket.cancel('queue', mex)
+            except TicketStateError:
+                messages.warning(request, "The ticket was already closed", "Warning")
             return redirect(reverse('queues:queue_manage', args=[pk]))
     else:
         form = MessageForm()
@@ -470,8 +547,8 @@ def queue_manage_exception(request: HttpRequest, pk: uuid4):
     if user_role != QueueUserRole.OWNER:
         raise Http404()
 
-    now = timezone.localtime()
-    has_exception = queue.exc_schedule.filter(day=now.date()).count() > 0
+    now = datetime.now(queue.tz)
+    has_exception = now.date() in queue.get_schedule().exceptions
 
     if request.method == 'POST':
         form = QueueRangeExceptionForm(request.POST, queue=queue)
@@ -479,15 +556,21 @@ def queue_manage_exception(request: HttpRequest, pk: uuid4):
             queue.exc_schedule.filter(day=now.date()).delete()
             if form.cleaned_data['keep_closed']:
                 from_time, to_time = None, None
+                keep = None
             else:
                 from_time = form.cleaned_data['from_time']
                 to_time = form.cleaned_data['to_time']
+                keep = (from_time, to_time)
             QueueOpenException(
                 queue=queue,
                 day=now.date(),
                 from_time=from_time,
                 to_time=to_time,
             ).save()
+            if form.cleaned_data['cancel_tickets']:
+                # Everything that is left out of the new opening hours (before or after), in one go
+                n = queue.close_day(now.date(), form.cleaned_data['message'] or "Sorry, the queue closed", keep=keep)
+                messages.success(request, f"{n} tickets cancelled", "Success")
             return redirect(reverse('queues:queue_manage', args=[pk]))
     else:
         form = QueueRangeExceptionForm(queue=queue)
@@ -571,6 +654,8 @@ def list_my_tickets(request: HttpRequest):
             t.card_style = 'text-white bg-secondary'
         if t.state in (TicketState.QUEUE_CANCELLED, TicketState.USER_CANCELLED):
             t.card_style = 'bg-warning'
+        if t.state == TicketState.EXPIRED:
+            t.card_style = 'bg-light'
 
     ctx = {
         'tickets': tickets
@@ -587,8 +672,34 @@ def ticket_details(request: HttpRequest, pk: int):
     return render(request, 'tickets/detail.html', context={
         'object': ticket,
         'time': ticket.requested_time.astimezone(request.user.tz).strftime('%Y-%m-%d %H:%M'),
+        'events_url': get_events_url(ticket.queue_id, ticket.id),
+        'position': get_position(ticket),
     })
 
+@login_required
+def api_ticket_position(request: HttpRequest, pk: int):
+    ticket = get_object_or_404(Ticket.objects.select_related('queue'), id=pk)
+
+    if not (request.user.is_superuser or request.user.id == ticket.user_id):
+        return HttpResponseForbidden()
+
+    # Output: { state, position, ahead, eta, waitSecs }, the position fields are null once the ticket is closed
+    def compute():
+        position = get_position(ticket)
+        return JsonResponse({
+            'state': ticket.state,
+            'position': position and position['position'],
+            'ahead': position and position['ahead'],
+            'eta': position and position['eta'].isoformat(),
+            'waitSecs': position and position['waitSecs'],
+        })
+
+    # The wait is counted down, clients polling within the same minute get a 304
+    queue = ticket.queue
+    clock = datetime.now(queue.tz).strftime('%Y-%m-%d %H:%M')
+    etag = make_etag(ticket.id, ticket.state, queue.version, clock)
+    return conditional_response(request, etag, None, compute, private=True)
+
 @login_required
 def ticket_cancel(request: HttpRequest, pk: int):
     ticket = get_object_or_404(Ticket, id=pk)
@@ -601,7 +712,10 @@ def ticket_cancel(request: HttpRequest, pk: int):
 
         if form.is_valid():
             mex = form.cleaned_data['message']
-            ticket.cancel('user', mex)
+            try:
+                ticket.cancel('user', mex)
+            except TicketStateError:
+                messages.warning(request, "The ticket was already closed", "Warning")
             return redirect(reverse('queues:ticket_list'))
     else:
         form = MessageForm()
@@ -13,4 +13,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'queuify.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from queues.events import EventStreamApp
+
+# Event streams (see queues.events) are served outside of Django's request handling
+application = EventStreamApp(django_application)
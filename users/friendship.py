@@ -0,0 +1,52 @@
+from typing import Tuple
+from django.db.models import Exists, OuterRef, QuerySet
+from django.shortcuts import get_object_or_404
+
+from .models import User, UserFriend
+
+# Friendship status of a user as seen by another one (see get_status), used by the templates
+UNAUTHENTICATED = 'unauthenticated'
+ME = 'me'
+FRIEND = 'friend'
+REQUEST_SENT = 'request_sent'
+REQUEST_RECEIVED = 'request_received'
+NOT_FRIEND = 'not_friend'
+
+
+def annotate_friendship(queryset: QuerySet, me) -> QuerySet:
+    """
+    Annotates the users of queryset with is_friend, request_sent and request_received, as seen by me.
+
+    Every flag is an EXISTS on the indexed relation tables, so a whole page of users
+    costs one query, whatever the number of friends of me.
+    """
+    requests = User.friend_requests.through
+    return queryset.annotate(
+        is_friend=Exists(UserFriend.objects.filter(user_from=me.id, user_to=OuterRef('pk'))),
+        request_sent=Exists(requests.objects.filter(from_user=me.id, to_user=OuterRef('pk'))),
+        request_received=Exists(requests.objects.filter(from_user=OuterRef('pk'), to_user=me.id)),
+    )
+
+
+def get_status(user, me) -> str:
+    # user must come from annotate_friendship, unless it's me or me is anonymous
+    if not me.is_authenticated:
+        return UNAUTHENTICATED
+    if user.id == me.id:
+        return ME
+    if user.is_friend:
+        return FRIEND
+    if user.request_sent:
+        return REQUEST_SENT
+    if user.request_received:
+        return REQUEST_RECEIVED
+    return NOT_FRIEND
+
+
+def get_user_and_status(user_id: int, me) -> Tuple[User, str]:
+    # A single user and its status in one query, Http404 if it does not exist
+    queryset = User.objects.all()
+    if me.is_authenticated:
+        queryset = annotate_friendship(queryset, me)
+    user = get_object_or_404(queryset, id=user_id)
+    return user, get_status(user, me)
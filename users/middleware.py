@@ -1,14 +1,12 @@
 from django.http import HttpRequest
 from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
 
 
-class TimezoneMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request: HttpRequest):
+class TimezoneMiddleware(MiddlewareMixin):
+    # Sync and async capable (through MiddlewareMixin), so that async views are not run in a thread
+    def process_request(self, request: HttpRequest):
         if request.user.is_authenticated:
             timezone.activate(request.user.tz)
         else:
             timezone.deactivate()
-        return self.get_response(request)
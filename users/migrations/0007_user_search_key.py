@@ -0,0 +1,27 @@
+# Generated by Django 4.0.5 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+def fill_search_keys(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+
+    users = list(User.objects.only('id', 'username'))
+    for user in users:
+        user.search_key = user.username.casefold()
+    User.objects.bulk_update(users, ['search_key'], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_remove_user_notification_subscription'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='search_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=150),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+    ]
@@ -14,6 +14,15 @@ class User(AbstractUser):
     friends = models.ManyToManyField('User', through='UserFriend', related_name="_unused_friends_related")
     friend_requests = models.ManyToManyField('User', related_name="received_friend_requests")
 
+    # Case-folded username, indexed for the prefix range scans of users.search
+    search_key = models.CharField(max_length=150, db_index=True, editable=False, default="")
+
+    def save(self, *args, **kwargs):
+        self.search_key = self.username.casefold()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'username' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'search_key'}
+        super().save(*args, **kwargs)
 
 
 class UserFriend(models.Model):
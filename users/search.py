@@ -0,0 +1,62 @@
+from typing import List, Optional, Tuple
+from django.core.cache import cache
+from django.db.models import QuerySet
+
+from core.utils import make_etag
+
+# Suggestions returned for a prefix
+AUTOCOMPLETE_LIMIT = 8
+# Usernames can't be longer, a longer prefix can't match anything
+AUTOCOMPLETE_MAX_CHARS = 150
+# Suggestions are shared by every client typing the same prefix, new users show up after this
+AUTOCOMPLETE_CACHE_SECS = 60
+
+# Sorts after every character that can follow a prefix (UTF-8 and UTF-16 alike)
+KEY_MAX_CHAR = '\U0010ffff'
+
+
+def prefix_range(text: str) -> Optional[Tuple[str, str]]:
+    # Bounds of the search keys that start with text, None if nothing to search
+    prefix = text.strip().casefold()
+    if not prefix or len(prefix) > AUTOCOMPLETE_MAX_CHARS:
+        return None
+    return prefix, prefix + KEY_MAX_CHAR
+
+
+def search_usernames(queryset: QuerySet, text: str) -> QuerySet:
+    """
+    Users of queryset whose username starts with text, ignoring case, in username order.
+
+    A range on the indexed search_key column instead of LIKE: SQLite's LIKE is case-insensitive
+    and can't use a plain index, a range is always an index scan on every database.
+    """
+    bounds = prefix_range(text)
+    if bounds is None:
+        return queryset.none()
+    return queryset\
+        .filter(search_key__gte=bounds[0], search_key__lt=bounds[1])\
+        .order_by('search_key')
+
+
+def autocomplete_cache_key(prefix: str) -> str:
+    return 'user-autocomplete-' + make_etag(prefix).strip('"')
+
+
+def get_suggestions(text: str) -> List[dict]:
+    # Cached by case-folded prefix, so every keystroke of every client is at most one index scan a minute
+    from .models import User
+
+    bounds = prefix_range(text)
+    if bounds is None:
+        return []
+    key = autocomplete_cache_key(bounds[0])
+    suggestions = cache.get(key)
+    if suggestions is None:
+        users = search_usernames(User.objects.filter(is_active=True), text)\
+            .values_list('id', 'username', 'first_name', 'last_name')[:AUTOCOMPLETE_LIMIT]
+        suggestions = [
+            {'id': user_id, 'username': username, 'name': f'{first_name} {last_name}'.strip()}
+            for user_id, username, first_name, last_name in users
+        ]
+        cache.set(key, suggestions, AUTOCOMPLETE_CACHE_SECS)
+    return suggestions
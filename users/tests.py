@@ -1,6 +1,11 @@
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from . import friendship
 from .models import User
+from .search import search_usernames
 
 class UsersCase(TestCase):
     def setUp(self):
@@ -67,6 +72,77 @@ class UsersCase(TestCase):
         self.assertEqual(res.context['result'], [self.auser])
         self.assertContains(res, 'You!')
 
+    def test_autocomplete(self):
+        cache.clear()
+        res = self.client.get(reverse('users:autocomplete'), data={"q": 'test'})
+        self.assertEqual(res.status_code, 302)
+
+        self.client.login(**self.acredentials)
+        # Case-insensitive prefix of the username, in username order
+        res = self.client.get(reverse('users:autocomplete'), data={"q": 'TEST_users_'})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('max-age', res['Cache-Control'])
+        self.assertEqual([x['username'] for x in res.json()['results']], ['test_users_a', 'test_users_b', 'test_users_c'])
+        self.assertEqual(res.json()['results'][1]['name'], 'Bertozzi Birimbumbim')
+        # Only prefixes
+        res = self.client.get(reverse('users:autocomplete'), data={"q": 'users'})
+        self.assertEqual(res.json()['results'], [])
+        res = self.client.get(reverse('users:autocomplete'), data={"q": ''})
+        self.assertEqual(res.json()['results'], [])
+
+        # Renames are found (once the cached suggestions expire)
+        self.buser.username = 'Bianca'
+        self.buser.save(update_fields=['username'])
+        cache.clear()
+        res = self.client.get(reverse('users:autocomplete'), data={"q": 'bi'})
+        self.assertEqual([x['id'] for x in res.json()['results']], [self.buser.id])
+
+        # Range scan of the index, not a scan of the table
+        if connection.vendor == 'sqlite':
+            query = search_usernames(User.objects.all(), 'test').values('id').query
+            with connection.cursor() as cursor:
+                sql, params = query.sql_with_params()
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('search_key', plan)
+            self.assertNotIn('SCAN users_user', plan)
+
+    def test_friendship_status(self):
+        dcredentials = {"username": "test_users_d", "password": "dddddddd"}
+        duser = User.objects.create_user(**dcredentials)
+        duser.friend_requests.add(self.auser)
+        # a received request from d, b and c get many friends: statuses must not depend on them
+        for i in range(20):
+            other = User.objects.create_user(username=f"test_users_friend_{i}", password="x")
+            self.buser.friends.add(other)
+            self.cuser.friend_requests.add(other)
+
+        users = friendship.annotate_friendship(User.objects.filter(username__in=["test_users_a", "test_users_b", "test_users_c", "test_users_d"]), self.auser)
+        with self.assertNumQueries(1):
+            statuses = {u.username: friendship.get_status(u, self.auser) for u in users}
+        self.assertEqual(statuses, {
+            "test_users_a": friendship.ME,
+            "test_users_b": friendship.FRIEND,
+            "test_users_c": friendship.REQUEST_SENT,
+            "test_users_d": friendship.REQUEST_RECEIVED,
+        })
+        self.assertEqual(friendship.get_user_and_status(self.auser.id, duser), (self.auser, friendship.REQUEST_SENT))
+
+        self.client.login(**self.acredentials)
+        res = self.client.get(reverse('users:profile', args=[duser.id]))
+        self.assertEqual(res.context['friend_status'], friendship.REQUEST_RECEIVED)
+        # Search: one query for the results and their statuses, whatever the number of results
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(reverse('users:search'), data={"q": 'test_users'})
+        self.assertEqual(len([q for q in queries if 'users_userfriend' in q['sql']]), 1)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.context['result']), 24)
+        self.assertEqual([u.state for u in res.context['result'][:2]], ['you', 'friend'])
+
+        self.client.logout()
+        res = self.client.get(reverse('users:profile', args=[duser.id]))
+        self.assertEqual(res.context['friend_status'], friendship.UNAUTHENTICATED)
+
     def test_make_request(self):
         self.client.login(**self.bcredentials)
 
@@ -21,5 +21,6 @@ urlpatterns = [
     path('friends/reject/<int:ifriend>', v.reject_friend, name='reject_friend'), # Reject received friend request
 
     path('search/', v.search, name='search'),
+    path('autocomplete/', v.autocomplete, name='autocomplete'),
     path('notification_subscribe/', v.notification_subscribe, name='notification_subscribe')
 ]
@@ -1,6 +1,5 @@
-from copy import copy
 from django.http import Http404, HttpRequest, JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.shortcuts import redirect, render
 from django.urls import reverse, reverse_lazy
 from django.views.generic import DetailView, CreateView, UpdateView
 from django.contrib.auth import authenticate, login
@@ -10,11 +9,14 @@ from django.contrib.auth.views import LoginView
 from django.contrib import messages
 from django.utils import timezone
 from django.db.models import Q
+from django.utils.cache import patch_cache_control
 
 
 
+from . import friendship
 from .forms import EditUserForm, CreateUserForm
 from .models import User
+from .search import AUTOCOMPLETE_CACHE_SECS, get_suggestions
 
 class CustomLoginView(LoginView):
     def form_valid(self, form):
@@ -28,24 +30,19 @@ class UserDetailView(DetailView):
     model = User
     context_object_name = 'quser'
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.user.is_authenticated:
+            queryset = friendship.annotate_friendship(queryset, self.request.user)
+        return queryset
+
     def get_context_data(self, **kwargs):
         data = super().get_context_data(**kwargs)
-        me = self.request.user
         user = data['object']
-        friend_status = 'unauthenticated'
-        if self.request.user.is_authenticated:
-            if user == me:
-                friend_status = 'me'
-                data['friend_count'] = user.friends.count()
-                data['local_time'] = timezone.localtime().strftime('%H:%M')
-            elif user in me.friends.all():
-                friend_status = 'friend'
-            elif user in me.friend_requests.all():
-                friend_status = 'request_sent'
-            elif user in me.received_friend_requests.all():
-                friend_status = 'request_received'
-            elif user.is_authenticated:
-                friend_status = 'not_friend'
+        friend_status = friendship.get_status(user, self.request.user)
+        if friend_status == friendship.ME:
+            data['friend_count'] = user.friends.count()
+            data['local_time'] = timezone.localtime().strftime('%H:%M')
         data['friend_status'] = friend_status
         return data
 
@@ -81,25 +78,32 @@ class UserCreateView(CreateView):
 def search(request: HttpRequest):
     query = request.GET.get('q') or ''
     if query != '':
-        result = list(User.objects.filter(Q(username__contains=query) | Q(first_name__contains=query) | Q(last_name__contains=query)))
+        result = User.objects.filter(Q(username__contains=query) | Q(first_name__contains=query) | Q(last_name__contains=query))
+        if request.user.is_authenticated:
+            result = friendship.annotate_friendship(result, request.user)
+        result = list(result)
     else:
         result = []
 
-    result = [copy(r) for r in result]
     for r in result:
-        r.state = 'none'
-        if not request.user.is_authenticated:
-            continue
-        if r == request.user:
-            r.state = 'you'
-        elif r in request.user.friends.all():
-            r.state = 'friend'
+        status = friendship.get_status(r, request.user)
+        r.state = {friendship.ME: 'you', friendship.FRIEND: 'friend'}.get(status, 'none')
 
     return render(request, 'user/search.html', context={
         'result': result,
         'query': query,
     })
 
+@login_required
+def autocomplete(request: HttpRequest):
+    # Username suggestions for the forms asking for an existing user (see user/username_autocomplete.html)
+    response = JsonResponse({
+        'results': get_suggestions(request.GET.get('q') or ''),
+    })
+    # Clients don't ask twice for the same prefix while typing and deleting
+    patch_cache_control(response, private=True, max_age=AUTOCOMPLETE_CACHE_SECS)
+    return response
+
 @login_required
 def user_self(request: HttpRequest):
     return redirect(reverse('users:profile', kwargs={'pk': request.user.id}))
@@ -125,11 +129,11 @@ def friends(request: HttpRequest):
 
 @login_required
 def remove_friend(request: HttpRequest, ifriend: int):
-    friend = get_object_or_404(User, id=ifriend)
+    friend, status = friendship.get_user_and_status(ifriend, request.user)
 
     user = request.user
-    is_friend = friend in user.friends.all()
-    if not (is_friend or (friend in user.friend_requests.all())):
+    is_friend = status == friendship.FRIEND
+    if not (is_friend or status == friendship.REQUEST_SENT):
         raise Http404(
             f"{friend.username} is not your friend"
         )
@@ -152,10 +156,10 @@ def remove_friend(request: HttpRequest, ifriend: int):
 
 @login_required
 def reject_friend(request: HttpRequest, ifriend: int):
-    friend = get_object_or_404(User, id=ifriend)
+    friend, status = friendship.get_user_and_status(ifriend, request.user)
 
     user = request.user
-    if friend not in user.received_friend_requests.all():
+    if status != friendship.REQUEST_RECEIVED:
         messages.error(request, f"{user.first_name} is not your friend", "Error")
         return redirect(reverse('users:friends'))
 
@@ -173,9 +177,9 @@ def reject_friend(request: HttpRequest, ifriend: int):
 @login_required
 def add_friend(request: HttpRequest, iother: int):
     user = request.user
-    other = get_object_or_404(User, id=iother)
+    other, status = friendship.get_user_and_status(iother, user)
 
-    if other in user.friends.all() or (other in user.friend_requests.all()) or user.id == iother:
+    if status in [friendship.FRIEND, friendship.REQUEST_SENT, friendship.ME]:
         # User is already a friend, or
         # Request already made, we cannot make two requests or
         # user is me
@@ -183,7 +187,7 @@ def add_friend(request: HttpRequest, iother: int):
         return redirect(reverse('users:friends'))
 
     is_confirmation = False
-    if user in other.friend_requests.all():
+    if status == friendship.REQUEST_RECEIVED:
         if request.method == 'POST':
             # Friendship accepted :3
             other.friend_requests.remove(user)